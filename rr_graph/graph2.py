@@ -3,9 +3,23 @@ and provides simple fast lookup required to build real FPGA rr graph fabrics.
 """
 
 from __future__ import print_function
-from collections import namedtuple
+import gc
+import heapq
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import tracemalloc
+from array import array
+from collections import namedtuple, Counter
+from collections.abc import Sequence
+from contextlib import contextmanager
 from enum import Enum
-from .tracks import Track
+from functools import wraps
+from itertools import accumulate, chain, repeat
+from .tracks import Direction
 from . import channel2
 from . import progressbar_utils
 
@@ -206,6 +220,1067 @@ class GraphInput(namedtuple('GraphInput',
     """
 
 
+# Flyweight caches of node attribute values.  A graph has only a handful of
+# distinct timing and segment values, shared by millions of nodes, so nodes
+# read or materialized from a NodeStore refer to one shared (immutable)
+# object per distinct value.
+NODE_TIMING_CACHE = {}
+NODE_SEGMENT_CACHE = {}
+
+
+def intern_node_timing(r, c):
+    """ Return the shared NodeTiming(r=r, c=c).
+
+    Equal values of different types (1 and 1.0) are serialized differently,
+    so they are interned separately.
+
+    """
+    key = (r, c, r.__class__, c.__class__)
+    timing = NODE_TIMING_CACHE.get(key)
+    if timing is None:
+        timing = NODE_TIMING_CACHE[key] = NodeTiming(r=r, c=c)
+    return timing
+
+
+def intern_node_segment(segment_id):
+    """ Return the shared NodeSegment(segment_id=segment_id). """
+    segment = NODE_SEGMENT_CACHE.get(segment_id)
+    if segment is None:
+        segment = NODE_SEGMENT_CACHE[segment_id] = NodeSegment(
+            segment_id=segment_id
+        )
+    return segment
+
+
+def clear_intern_caches():
+    """ Drop all interned values, e.g. after the last graph was freed. """
+    NODE_TIMING_CACHE.clear()
+    NODE_SEGMENT_CACHE.clear()
+
+
+# Sentinels used by NodeStore for fields that are None.  Enum columns are
+# stored as their (non-negative) enum value, other integer columns can
+# legitimately hold small negative numbers.
+_NULL_ENUM = -1
+_NULL_INT = -(1 << 31)
+
+_NODE_TYPES = tuple(sorted(NodeType, key=lambda e: e.value))
+_NODE_DIRECTIONS = tuple(sorted(NodeDirection, key=lambda e: e.value))
+_SIDES = tuple(sorted(Direction, key=lambda e: e.value))
+
+
+def _enum_code(e):
+    # Enum._value_ is a plain attribute, unlike the (much slower) Enum.value
+    # property.
+    return _NULL_ENUM if e is None else e._value_
+
+
+def _int_timing(timing):
+    # Integer timing values are serialized without a fractional part ("1"
+    # instead of "1.0"), so NodeStore records which of r (bit 0) and c
+    # (bit 1) were ints.
+    if timing is None:
+        return 0
+    return (timing.r.__class__ is int) | (timing.c.__class__ is int) << 1
+
+
+@contextmanager
+def _gc_paused():
+    """ Pause the cyclic garbage collector.
+
+    Building millions of small acyclic objects (e.g. index tuples) triggers
+    repeated collections that rescan the whole heap, which can dominate the
+    build time of large graphs.
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _deep_sizeof(obj, seen):
+    """ Estimate the size in bytes of obj and everything reachable from it.
+
+    Objects whose id is in seen are skipped, and every visited object is
+    added to seen, so sharing one seen set between calls counts shared
+    objects only once.  Classes, enum members and functions are not counted.
+
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, (type, Enum)) or callable(obj):
+            continue
+
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, int, float, array)):
+            continue
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+
+    return size
+
+
+class MemoryPhaseTracker(object):
+    """ Records the peak traced memory of each graph building phase.
+
+    While the tracker is active (used as a context manager), every
+    memory_phase (construction, create_channels and serialize) records the
+    peak memory traced by tracemalloc while it ran.  tracemalloc is started
+    if it is not already tracing, and stopped again on exit.  Tracing slows
+    down Python allocations considerably, so this is opt-in.
+
+    >>> with MemoryPhaseTracker() as tracker:
+    ...     graph = Graph(...)
+    ...     graph.create_channels(...)
+    >>> tracker.peaks
+    {'construction': ..., 'create_channels': ...}
+
+    Attributes
+    ----------
+    peaks : dict of str to int
+        Peak traced memory in bytes, keyed by phase name.  A phase that runs
+        more than once records the highest peak.
+
+    """
+
+    def __init__(self):
+        self.peaks = {}
+        self._phases = []
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _memory_phase_tracker
+        assert _memory_phase_tracker is None
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        _memory_phase_tracker = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _memory_phase_tracker
+        _memory_phase_tracker = None
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _update_peaks(self):
+        # tracemalloc has a single peak counter, so before it is reset the
+        # current peak is recorded in all enclosing phases.
+        _, peak = tracemalloc.get_traced_memory()
+        for name in self._phases:
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+    def begin_phase(self, name):
+        self._update_peaks()
+        tracemalloc.reset_peak()
+        self._phases.append(name)
+
+    def end_phase(self, name):
+        self._update_peaks()
+        assert self._phases.pop() == name
+
+
+_memory_phase_tracker = None
+
+
+def memory_phase(name):
+    """ Decorate a function as a named phase for MemoryPhaseTracker. """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tracker = _memory_phase_tracker
+            if tracker is None:
+                return f(*args, **kwargs)
+
+            tracker.begin_phase(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                tracker.end_phase(name)
+
+        return wrapper
+
+    return decorator
+
+
+def _as_array(typecode, values):
+    """ Convert values to an array.array of the given typecode.
+
+    values may be an array.array, any object supporting the buffer
+    protocol (e.g. memoryview or NumPy array) or any iterable of ints.
+    Buffers that already have the requested layout are copied without
+    going through Python ints.
+
+    """
+    if isinstance(values, array) and values.typecode == typecode:
+        return values
+
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return array(typecode, values)
+
+    out = array(typecode)
+    if view.ndim == 1 and view.format.lstrip('@=') == typecode and \
+            view.itemsize == out.itemsize and view.c_contiguous:
+        out.frombytes(view.cast('B'))
+    else:
+        out.fromlist(view.tolist())
+
+    return out
+
+
+def _store_from_columns(store, columns):
+    for name, value in columns.items():
+        if name in store.COLUMNS:
+            assert isinstance(value, array), name
+            assert value.typecode == getattr(store, name).typecode, name
+        else:
+            assert name in store.SPARSE_FIELDS, name
+        setattr(store, name, value)
+
+    lengths = set(len(getattr(store, name)) for name in store.COLUMNS)
+    assert len(lengths) == 1, lengths
+
+    return store
+
+
+class NodeStore(Sequence):
+    """ Columnar (struct of arrays) storage of graph nodes.
+
+    Storing millions of Node namedtuples (each with nested NodeLoc,
+    NodeTiming and NodeSegment tuples) costs several hundred bytes per node.
+    NodeStore instead keeps one typed array per scalar field and only
+    materializes Node objects when they are accessed, so it can be used
+    anywhere a list of Node objects was used before.
+
+    Fields that are rarely present (metadata, canonical_loc, connection_box)
+    are kept in sparse dictionaries of node index to value.
+
+    Attributes
+    ----------
+    id, type, direction, capacity, x_low, y_low, x_high, y_high, side, ptc,
+    r, c, int_timing, segment_id : array.array
+        Node columns.  Enum columns hold the enum value, or -1 for None.
+        ptc and segment_id hold -2**31 for None, r and c hold NaN when the
+        node has no timing.  int_timing has bit 0 (1) set if r and bit 1
+        (2) set if c was an int, so it is returned as an int.
+    metadata, canonical_loc, connection_box : dict
+        Map of node index to value, for nodes where the field is not None.
+
+    """
+
+    COLUMNS = (
+        'id', 'type', 'direction', 'capacity', 'x_low', 'y_low', 'x_high',
+        'y_high', 'side', 'ptc', 'r', 'c', 'int_timing', 'segment_id'
+    )
+    SPARSE_FIELDS = ('metadata', 'canonical_loc', 'connection_box')
+
+    def __init__(self, nodes=()):
+        self.id = array('i')
+        self.type = array('b')
+        self.direction = array('b')
+        self.capacity = array('i')
+        self.x_low = array('h')
+        self.y_low = array('h')
+        self.x_high = array('h')
+        self.y_high = array('h')
+        self.side = array('b')
+        self.ptc = array('i')
+        self.r = array('d')
+        self.c = array('d')
+        self.int_timing = array('b')
+        self.segment_id = array('i')
+
+        self.metadata = {}
+        self.canonical_loc = {}
+        self.connection_box = {}
+
+        self.extend(nodes)
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """ Create a NodeStore adopting (not copying) column arrays.
+
+        Keyword arguments are columns (array.array with the typecode of the
+        column, see COLUMNS) and optionally sparse fields (see
+        SPARSE_FIELDS).  Columns not given are empty.
+
+        """
+        return _store_from_columns(cls(), columns)
+
+    def _columns(self):
+        return (
+            self.id, self.type, self.direction, self.capacity, self.x_low,
+            self.y_low, self.x_high, self.y_high, self.side, self.ptc, self.r,
+            self.c, self.int_timing, self.segment_id
+        )
+
+    def __len__(self):
+        return len(self.id)
+
+    def _make_node(
+            self, idx, node_id, type, direction, capacity, x_low, y_low,
+            x_high, y_high, side, ptc, r, c, int_timing, segment_id
+    ):
+        return Node(
+            id=node_id,
+            type=None if type == _NULL_ENUM else _NODE_TYPES[type],
+            direction=None
+            if direction == _NULL_ENUM else _NODE_DIRECTIONS[direction],
+            capacity=capacity,
+            loc=NodeLoc(
+                x_low=x_low,
+                y_low=y_low,
+                x_high=x_high,
+                y_high=y_high,
+                side=None if side == _NULL_ENUM else _SIDES[side],
+                ptc=None if ptc == _NULL_INT else ptc,
+            ),
+            timing=None if r != r else intern_node_timing(
+                int(r) if int_timing & 1 else r,
+                int(c) if int_timing & 2 else c,
+            ),
+            metadata=self.metadata.get(idx),
+            segment=None
+            if segment_id == _NULL_INT else intern_node_segment(segment_id),
+            canonical_loc=self.canonical_loc.get(idx),
+            connection_box=self.connection_box.get(idx),
+        )
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        return self._make_node(
+            idx, *(column[idx] for column in self._columns())
+        )
+
+    def __iter__(self):
+        for idx, values in enumerate(zip(*self._columns())):
+            yield self._make_node(idx, *values)
+
+    def _set_sparse(self, field, idx, value):
+        if value is None:
+            field.pop(idx, None)
+        else:
+            field[idx] = value
+
+    def __setitem__(self, idx, node):
+        if idx < 0:
+            idx += len(self)
+
+        if idx < 0 or idx >= len(self):
+            raise IndexError('NodeStore index out of range')
+
+        loc = node.loc
+        timing = node.timing
+
+        self.id[idx] = node.id
+        self.type[idx] = _enum_code(node.type)
+        self.direction[idx] = _enum_code(node.direction)
+        self.capacity[idx] = node.capacity
+        self.x_low[idx] = loc.x_low
+        self.y_low[idx] = loc.y_low
+        self.x_high[idx] = loc.x_high
+        self.y_high[idx] = loc.y_high
+        self.side[idx] = _enum_code(loc.side)
+        self.ptc[idx] = _NULL_INT if loc.ptc is None else loc.ptc
+        self.r[idx] = float('nan') if timing is None else timing.r
+        self.c[idx] = float('nan') if timing is None else timing.c
+        self.int_timing[idx] = _int_timing(timing)
+        self.segment_id[idx] = _NULL_INT if node.segment is None else \
+            node.segment.segment_id
+
+        self._set_sparse(self.metadata, idx, node.metadata)
+        self._set_sparse(self.canonical_loc, idx, node.canonical_loc)
+        self._set_sparse(self.connection_box, idx, node.connection_box)
+
+    def append(self, node):
+        """ Append a Node, one array.append per column. """
+        loc = node.loc
+        timing = node.timing
+        idx = len(self.id)
+
+        try:
+            self.id.append(node.id)
+            self.type.append(_enum_code(node.type))
+            self.direction.append(_enum_code(node.direction))
+            self.capacity.append(node.capacity)
+            self.x_low.append(loc.x_low)
+            self.y_low.append(loc.y_low)
+            self.x_high.append(loc.x_high)
+            self.y_high.append(loc.y_high)
+            self.side.append(_enum_code(loc.side))
+            self.ptc.append(_NULL_INT if loc.ptc is None else loc.ptc)
+            if timing is None:
+                self.r.append(float('nan'))
+                self.c.append(float('nan'))
+            else:
+                self.r.append(timing.r)
+                self.c.append(timing.c)
+            self.int_timing.append(_int_timing(timing))
+            self.segment_id.append(
+                _NULL_INT if node.segment is None else node.segment.segment_id
+            )
+        except (OverflowError, TypeError):
+            # Keep columns the same length if a value does not fit.
+            for column in self._columns():
+                del column[idx:]
+            raise
+
+        if node.metadata is not None:
+            self.metadata[idx] = node.metadata
+        if node.canonical_loc is not None:
+            self.canonical_loc[idx] = node.canonical_loc
+        if node.connection_box is not None:
+            self.connection_box[idx] = node.connection_box
+
+    def extend(self, nodes):
+        """ Append Node objects, one column at a time. """
+        if not isinstance(nodes, (list, tuple)):
+            nodes = list(nodes)
+
+        nan = float('nan')
+
+        locs = [node.loc for node in nodes]
+        timings = [node.timing for node in nodes]
+
+        # Convert every column before extending any, so a bad node leaves
+        # the store untouched.
+        values = (
+            [node.id for node in nodes],
+            [
+                _NULL_ENUM if node.type is None else node.type._value_
+                for node in nodes
+            ],
+            [
+                _NULL_ENUM
+                if node.direction is None else node.direction._value_
+                for node in nodes
+            ],
+            [node.capacity for node in nodes],
+            [loc.x_low for loc in locs],
+            [loc.y_low for loc in locs],
+            [loc.x_high for loc in locs],
+            [loc.y_high for loc in locs],
+            [
+                _NULL_ENUM if loc.side is None else loc.side._value_
+                for loc in locs
+            ],
+            [_NULL_INT if loc.ptc is None else loc.ptc for loc in locs],
+            [nan if timing is None else timing.r for timing in timings],
+            [nan if timing is None else timing.c for timing in timings],
+            [_int_timing(timing) for timing in timings],
+            [
+                _NULL_INT if node.segment is None else node.segment.segment_id
+                for node in nodes
+            ],
+        )
+        values = [
+            array(column.typecode, column_values)
+            for column, column_values in zip(self._columns(), values)
+        ]
+
+        first = len(self)
+        for column, column_values in zip(self._columns(), values):
+            column.extend(column_values)
+
+        for idx, node in enumerate(nodes, first):
+            if node.metadata is not None:
+                self.metadata[idx] = node.metadata
+            if node.canonical_loc is not None:
+                self.canonical_loc[idx] = node.canonical_loc
+            if node.connection_box is not None:
+                self.connection_box[idx] = node.connection_box
+
+    def add_nodes(
+            self, x_low, y_low, x_high, y_high, ptc, type, direction,
+            capacity, side, timing, segment
+    ):
+        """ Append a batch of nodes that only differ in location and ptc.
+
+        x_low, y_low, x_high, y_high and ptc are equal length sequences,
+        the other fields are shared by all new nodes and take the same
+        values as the Node fields.  Node ids are assigned sequentially.
+
+        Returns the range of the new node ids.
+
+        """
+        count = len(x_low)
+        assert len(y_low) == len(x_high) == len(y_high) == len(ptc) == count
+
+        first = len(self)
+
+        self.id.extend(range(first, first + count))
+        self.type.extend(repeat(type._value_, count))
+        self.direction.extend(repeat(_enum_code(direction), count))
+        self.capacity.extend(repeat(capacity, count))
+        self.x_low.extend(x_low)
+        self.y_low.extend(y_low)
+        self.x_high.extend(x_high)
+        self.y_high.extend(y_high)
+        self.side.extend(repeat(_enum_code(side), count))
+        self.ptc.extend(ptc)
+        self.r.extend(
+            repeat(float('nan') if timing is None else timing.r, count)
+        )
+        self.c.extend(
+            repeat(float('nan') if timing is None else timing.c, count)
+        )
+        self.int_timing.extend(repeat(_int_timing(timing), count))
+        self.segment_id.extend(
+            repeat(
+                _NULL_INT if segment is None else segment.segment_id, count
+            )
+        )
+
+        return range(first, len(self))
+
+    def sort(self, key=None):
+        """ Sort nodes in place.
+
+        When key is None, nodes are sorted by id without materializing any
+        Node objects.
+
+        """
+        if key is None:
+            order = sorted(range(len(self)), key=self.id.__getitem__)
+        else:
+            order = sorted(range(len(self)), key=lambda idx: key(self[idx]))
+
+        if order == list(range(len(order))):
+            return
+
+        for column in self._columns():
+            column[:] = array(column.typecode, map(column.__getitem__, order))
+
+        sparse_fields = (
+            self.metadata, self.canonical_loc, self.connection_box
+        )
+        if not any(sparse_fields):
+            return
+
+        new_idx = array('i', order)
+        for new, old in enumerate(order):
+            new_idx[old] = new
+
+        for field in sparse_fields:
+            items = list(field.items())
+            field.clear()
+            field.update((new_idx[idx], value) for idx, value in items)
+
+
+class EdgeStore(Sequence):
+    """ Columnar storage of graph edges.
+
+    Edges are kept as parallel uint32 arrays of source node, sink node and
+    switch id.  array.array over-allocates on append, so growth is
+    geometric and amortized O(1) per edge.  Edge metadata is rare, so it is
+    kept in a sparse dict of edge index to metadata.
+
+    Iteration and indexing yield Edge tuples, so EdgeStore can be used
+    anywhere a list of (src_node, sink_node, switch_id, metadata) tuples
+    was used before.
+
+    Attributes
+    ----------
+    src_node, sink_node, switch_id : array.array
+        Edge columns.
+    metadata : dict
+        Map of edge index to metadata, for edges with metadata.
+
+    """
+
+    COLUMNS = ('src_node', 'sink_node', 'switch_id')
+    SPARSE_FIELDS = ('metadata', )
+
+    def __init__(self, edges=()):
+        self.src_node = array('I')
+        self.sink_node = array('I')
+        self.switch_id = array('I')
+        self.metadata = {}
+
+        self.extend(edges)
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """ Create an EdgeStore adopting (not copying) column arrays.
+
+        See NodeStore.from_columns.
+
+        """
+        return _store_from_columns(cls(), columns)
+
+    def __len__(self):
+        return len(self.src_node)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        return Edge(
+            src_node=self.src_node[idx],
+            sink_node=self.sink_node[idx],
+            switch_id=self.switch_id[idx],
+            metadata=self.metadata.get(idx),
+        )
+
+    def __iter__(self):
+        return map(
+            Edge, self.src_node, self.sink_node, self.switch_id,
+            map(self.metadata.get, range(len(self)))
+        )
+
+    def add_edge(self, src_node, sink_node, switch_id, metadata=None):
+        """ Append an edge and return its index. """
+        idx = len(self.src_node)
+
+        try:
+            self.src_node.append(src_node)
+            self.sink_node.append(sink_node)
+            self.switch_id.append(switch_id)
+        except (OverflowError, TypeError):
+            # Keep columns the same length if a value does not fit.
+            del self.src_node[idx:]
+            del self.sink_node[idx:]
+            del self.switch_id[idx:]
+            raise
+
+        if metadata is not None:
+            self.metadata[idx] = metadata
+
+        return idx
+
+    def add_edges(self, src_node, sink_node, switch_id, metadata=None):
+        """ Append a batch of edges and return the range of their indices.
+
+        src_node, sink_node and switch_id must be array.array('I') of equal
+        length.  metadata is an optional sequence parallel to the batch,
+        entries that are None are skipped.
+
+        """
+        assert len(src_node) == len(sink_node) == len(switch_id)
+        assert metadata is None or len(metadata) == len(src_node)
+
+        first = len(self.src_node)
+
+        self.src_node.extend(src_node)
+        self.sink_node.extend(sink_node)
+        self.switch_id.extend(switch_id)
+
+        if metadata is not None:
+            self.metadata.update(
+                (first + idx, meta)
+                for idx, meta in enumerate(metadata)
+                if meta is not None
+            )
+
+        return range(first, len(self.src_node))
+
+    def append(self, edge):
+        src_node, sink_node, switch_id, metadata = edge
+        self.add_edge(src_node, sink_node, switch_id, metadata)
+
+    def extend(self, edges):
+        for edge in edges:
+            self.append(edge)
+
+    def _sorted_run(self, first, second, start, stop):
+        """ Return edges start..stop-1 sorted by (first, second, switch).
+
+        Each edge is packed into a single int, first << 96 | second << 64 |
+        switch_id << 32 | edge index, so equal edges stay in index order.
+
+        """
+        keys = [
+            a << 96 | b << 64 | switch << 32 | idx
+            for a, b, switch, idx in zip(
+                first[start:stop], second[start:stop],
+                self.switch_id[start:stop], range(start, stop)
+            )
+        ]
+        keys.sort()
+
+        return keys
+
+    def sort_and_dedup(
+            self,
+            order='src',
+            keep_first_metadata=True,
+            max_edges_in_memory=None,
+            scratch_dir=None
+    ):
+        """ Sort edges and remove duplicate edges.
+
+        Edges are sorted by (src_node, sink_node, switch_id) if order is
+        'src', or by (sink_node, src_node, switch_id) if order is 'sink'.
+        The sort is stable, so the first of a set of duplicates is the one
+        added first.
+
+        If keep_first_metadata is True, edges with the same
+        (src_node, sink_node, switch_id) are duplicates and only the first
+        is kept, with its metadata.  Otherwise only edges with equal metadata
+        too are duplicates.
+
+        If there are more than max_edges_in_memory edges, the edges are
+        sorted externally: sorted runs of at most max_edges_in_memory edges
+        are written to a temporary directory in scratch_dir (default: the
+        system temporary directory) as (first, second, switch_id, index)
+        records, the columns are released, and the runs are merged from disk
+        into new columns.  On top of the columns themselves (which must fit
+        in memory, once), memory use is then bounded by max_edges_in_memory
+        edges, roughly 80 bytes per edge, and the (sparse) metadata.
+
+        Returns
+        -------
+        int
+            The number of edges removed.
+
+        """
+        if order == 'src':
+            first, second = self.src_node, self.sink_node
+        elif order == 'sink':
+            first, second = self.sink_node, self.src_node
+        else:
+            assert False, order
+
+        num_edges = len(self)
+        if max_edges_in_memory is None or num_edges <= max_edges_in_memory:
+            self._dedup(
+                _unpack_edge_keys(
+                    self._sorted_run(first, second, 0, num_edges)
+                ), order, keep_first_metadata
+            )
+            return num_edges - len(self)
+
+        assert max_edges_in_memory > 0, max_edges_in_memory
+
+        with tempfile.TemporaryDirectory(prefix='rr_graph_edges_',
+                                         dir=scratch_dir) as tmpdir:
+            run_paths = []
+            for start in range(0, num_edges, max_edges_in_memory):
+                stop = min(start + max_edges_in_memory, num_edges)
+                run_path = os.path.join(tmpdir, 'run{}'.format(len(run_paths)))
+                with open(run_path, 'wb') as f:
+                    array(
+                        'I',
+                        chain.from_iterable(
+                            _unpack_edge_keys(
+                                self._sorted_run(first, second, start, stop)
+                            )
+                        )
+                    ).tofile(f)
+                run_paths.append(run_path)
+
+            # The runs hold every column value, so the columns are released
+            # before the merge builds the new ones.
+            del first, second
+            self.src_node = array('I')
+            self.sink_node = array('I')
+            self.switch_id = array('I')
+
+            block_size = max(max_edges_in_memory // len(run_paths), 1)
+            run_files = [open(run_path, 'rb') for run_path in run_paths]
+            try:
+                # Records compare as tuples, without a key function, and end
+                # with the edge index, so the merge is stable too.
+                self._dedup(
+                    heapq.merge(
+                        *(_read_run(f, block_size) for f in run_files)
+                    ), order, keep_first_metadata
+                )
+            finally:
+                for f in run_files:
+                    f.close()
+
+        return num_edges - len(self)
+
+    def _dedup(self, edges, order, keep_first_metadata):
+        """ Replace the columns with edges, skipping duplicates.
+
+        edges yields (first, second, switch_id, index) records in order,
+        where first and second are the src_node and sink_node (sink_node and
+        src_node if order is 'sink'), and index is the edge index in the
+        current columns, used to look up its metadata.  The current columns
+        are not read, so they may already be released.
+
+        """
+        src_node = array('I')
+        sink_node = array('I')
+        switch_id = array('I')
+        metadata = {}
+
+        if order == 'src':
+            first_append, second_append = src_node.append, sink_node.append
+        else:
+            first_append, second_append = sink_node.append, src_node.append
+        switch_id_append = switch_id.append
+
+        get_metadata = self.metadata.get
+        prev = None
+        prev_metadata = []
+
+        for first, second, switch, idx in edges:
+            edge = (first, second, switch)
+            meta = get_metadata(idx)
+
+            if edge == prev:
+                if keep_first_metadata or meta in prev_metadata:
+                    continue
+            else:
+                prev = edge
+                prev_metadata = []
+
+            prev_metadata.append(meta)
+            if meta is not None:
+                metadata[len(switch_id)] = meta
+
+            first_append(first)
+            second_append(second)
+            switch_id_append(switch)
+
+        self.src_node = src_node
+        self.sink_node = sink_node
+        self.switch_id = switch_id
+        self.metadata = metadata
+
+
+def _unpack_edge_keys(keys):
+    """ Yield (first, second, switch_id, index) of EdgeStore._sorted_run keys.
+    """
+    for key in keys:
+        yield (
+            key >> 96, key >> 64 & 0xFFFFFFFF, key >> 32 & 0xFFFFFFFF,
+            key & 0xFFFFFFFF
+        )
+
+
+def _read_run(f, block_size):
+    """ Yield the records of a run file, reading block_size at a time. """
+    while True:
+        block = array('I')
+        try:
+            block.fromfile(f, 4 * block_size)
+        except EOFError:
+            # The partial last block was still read.
+            yield from zip(*[iter(block)] * 4)
+            return
+
+        yield from zip(*[iter(block)] * 4)
+
+
+class EdgeIndex(object):
+    """ Compressed sparse row (CSR) index of edges by node.
+
+    The edges of node n are order[offsets[n]:offsets[n+1]], where order is
+    a permutation of edge indices built with a counting sort over keys
+    (typically EdgeStore.src_node or EdgeStore.sink_node).
+
+    Edges appended to keys after the index was built are picked up on the
+    next lookup and kept in a small overflow map.  Once the overflow is as
+    large as the CSR itself, the index is rebuilt.
+
+    """
+
+    def __init__(self, keys, num_nodes):
+        self.keys = keys
+        self.rebuild(num_nodes)
+
+    def rebuild(self, num_nodes):
+        keys = self.keys
+
+        if len(keys) > 0:
+            num_nodes = max(num_nodes, max(keys) + 1)
+
+        counts = [0] * (num_nodes + 1)
+        for key, count in Counter(keys).items():
+            counts[key + 1] = count
+
+        self.offsets = array('I', accumulate(counts))
+
+        next_slot = self.offsets[:-1]
+        order = array('I', bytes(next_slot.itemsize * len(keys)))
+        for idx, key in enumerate(keys):
+            order[next_slot[key]] = idx
+            next_slot[key] += 1
+
+        self.order = order
+        self.num_indexed = len(keys)
+        self.overflow = {}
+        self.num_overflow = 0
+
+    def update(self):
+        """ Index edges appended to keys since the last update. """
+        keys = self.keys
+        num_edges = len(keys)
+
+        if num_edges < self.num_indexed or \
+                num_edges - self.num_indexed + self.num_overflow > len(
+                    self.order):
+            self.rebuild(len(self.offsets) - 1)
+            return
+
+        for idx in range(self.num_indexed, num_edges):
+            key = keys[idx]
+            if key not in self.overflow:
+                self.overflow[key] = []
+            self.overflow[key].append(idx)
+
+        self.num_overflow += num_edges - self.num_indexed
+        self.num_indexed = num_edges
+
+    def edges(self, node):
+        """ Return list of edge indices for node. """
+        if len(self.keys) != self.num_indexed:
+            self.update()
+
+        if node + 1 < len(self.offsets):
+            edges = self.order[self.offsets[node]:self.offsets[node + 1]
+                               ].tolist()
+        else:
+            edges = []
+
+        if node in self.overflow:
+            edges.extend(self.overflow[node])
+
+        return edges
+
+
+# Snapshot file layout (version 2), all integers little endian:
+#  - prefix: magic, version, header offset and header size.
+#  - store columns, each starting at a multiple of 8 bytes, in native byte
+#    order.
+#  - header: pickle of the column locations, sparse store fields and all
+#    other Graph attributes, including the derived lookup maps.
+SNAPSHOT_MAGIC = b'RRGRAPH2'
+SNAPSHOT_VERSION = 2
+_SNAPSHOT_PREFIX = struct.Struct('<8sIQQ')
+
+
+def _write_store_columns(f, store):
+    columns = []
+    for name in store.COLUMNS:
+        column = getattr(store, name)
+        f.write(bytes(-f.tell() % 8))
+        columns.append(
+            (name, column.typecode, column.itemsize, f.tell(), len(column))
+        )
+        column.tofile(f)
+
+    return {
+        'columns': columns,
+        'sparse': {name: getattr(store, name)
+                   for name in store.SPARSE_FIELDS},
+    }
+
+
+def _read_store_columns(store, f, store_header, byteorder):
+    for name, typecode, itemsize, offset, length in store_header['columns']:
+        column = array(typecode)
+        assert column.itemsize == itemsize, (name, typecode, itemsize)
+        f.seek(offset)
+        column.fromfile(f, length)
+        if byteorder != sys.byteorder:
+            column.byteswap()
+        setattr(store, name, column)
+
+    for name, value in store_header['sparse'].items():
+        setattr(store, name, value)
+
+    return store
+
+
+def hilbert_index(x, y, order):
+    """ Return the distance of (x, y) along a Hilbert curve.
+
+    The curve fills the square [0, 2**order) x [0, 2**order).  Points that
+    are close on the curve are close in the plane.
+
+    """
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+
+    return d
+
+
+def node_remap_function(node_remap):
+    """ Return node_remap as a callable of old node id to new node id.
+
+    node_remap may already be a callable, or a sequence indexed by old node
+    id (e.g. an array.array as returned by Graph.compute_node_remap).  For a
+    sequence the returned callable is its C level __getitem__, so remapping
+    does not run any Python code per node.
+
+    """
+    if node_remap is None:
+        return lambda x: x  # noqa: E731
+
+    if callable(node_remap):
+        return node_remap
+
+    return _as_array('I', node_remap).__getitem__
+
+
+def node_remap_table(node_remap, num_nodes):
+    """ Return node_remap as an array('I') of new ids for ids 0..num_nodes-1.
+
+    A callable node_remap is called once per node id, so the table can be
+    used where the remap is applied many times (e.g. twice per edge).
+
+    """
+    if node_remap is None or callable(node_remap):
+        return remap_node_ids(node_remap, range(num_nodes))
+
+    table = _as_array('I', node_remap)
+    assert len(table) >= num_nodes, (len(table), num_nodes)
+
+    return table
+
+
+def remap_node_ids(node_remap, node_ids):
+    """ Return an array('I') of node_ids remapped through node_remap. """
+    return array('I', map(node_remap_function(node_remap), node_ids))
+
+
 def process_track(track):
     channel_model = channel2.Channel(track)
     channel_model.pack_tracks()
@@ -213,6 +1288,142 @@ def process_track(track):
     return channel_model
 
 
+def process_track_chunk(intervals_path, spans):
+    """ Pack a chunk of channels whose track intervals are in shared memory.
+
+    Arguments
+    ---------
+    intervals_path : str
+        Path of the file holding interleaved (low, high) int32 pairs for
+        every track of every channel.  The file is memory mapped, so all
+        workers share the same pages.
+    spans : list of (int, int)
+        [start, end) track range of each channel in this chunk.
+
+    Returns
+    -------
+    array.array of int
+        ptc of every track of the chunk, in span order.
+
+    """
+    with open(intervals_path, 'rb') as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        intervals = memoryview(mapped).cast('i')
+
+        ptcs = array('i')
+        for start, end in spans:
+            channel_model = process_track(
+                [
+                    (intervals[2 * idx], intervals[2 * idx + 1], idx - start)
+                    for idx in range(start, end)
+                ]
+            )
+
+            channel_ptcs = array('i', bytes(ptcs.itemsize * (end - start)))
+            for ptc, tree in enumerate(channel_model.trees):
+                for _, _, idx in tree:
+                    channel_ptcs[idx] = ptc
+
+            ptcs.extend(channel_ptcs)
+
+        intervals.release()
+
+    return ptcs
+
+
+def _balance_chunks(sizes, num_chunks):
+    """ Split items into at most num_chunks chunks of similar total size.
+
+    Largest items are placed first, each into the currently smallest chunk.
+    Returns list of chunks, each a sorted list of item indices.
+
+    """
+    chunks = [[] for _ in range(min(num_chunks, len(sizes)))]
+    loads = [(0, idx) for idx in range(len(chunks))]
+
+    for item in sorted(range(len(sizes)), key=lambda idx: -sizes[idx]):
+        load, idx = heapq.heappop(loads)
+        chunks[idx].append(item)
+        heapq.heappush(loads, (load + sizes[item], idx))
+
+    return [sorted(chunk) for chunk in chunks]
+
+
+def pack_channels_in_pool(channels, pool, num_chunks=None):
+    """ Pack channels in a process pool and return their channel models.
+
+    Instead of pickling each channel's track list (and the resulting
+    channel2.Channel) through the pool, the track intervals of all channels
+    are written once to a temporary file that every worker memory maps.
+    Channels are grouped into num_chunks chunks of similar track count, and
+    workers only return the ptc of each track.
+
+    A memory mapped file is used rather than multiprocessing.shared_memory,
+    because before Python 3.13 workers attaching to a SharedMemory block
+    register it with the resource tracker, which then reports it as leaked.
+
+    Packing is deterministic, so the returned models have the same trees as
+    process_track would produce.
+
+    Arguments
+    ---------
+    channels : list of list of (low, high, idx)
+        Tracks of each channel.
+    pool : multiprocessing.Pool
+    num_chunks : int
+        Number of chunks to submit, defaults to 4 per CPU.
+
+    Returns
+    -------
+    list of channel2.Channel, in channels order.
+
+    """
+    if num_chunks is None:
+        num_chunks = 4 * (os.cpu_count() or 1)
+
+    intervals = array('i')
+    spans = []
+    for tracks in channels:
+        start = len(intervals) // 2
+        for low, high, _ in tracks:
+            intervals.append(low)
+            intervals.append(high)
+        spans.append((start, start + len(tracks)))
+
+    chunks = _balance_chunks([len(tracks) for tracks in channels], num_chunks)
+
+    with tempfile.NamedTemporaryFile(prefix='rr_graph_tracks_') as f:
+        intervals.tofile(f)
+        f.flush()
+
+        results = [
+            pool.apply_async(
+                process_track_chunk, (f.name, [spans[i] for i in chunk])
+            ) for chunk in chunks
+        ]
+
+        channel_models = [None] * len(channels)
+        for chunk, result in zip(chunks, results):
+            ptcs = result.get()
+
+            offset = 0
+            for i in chunk:
+                tracks = channels[i]
+                channel_ptcs = ptcs[offset:offset + len(tracks)]
+                offset += len(tracks)
+
+                channel_model = channel2.Channel(tracks)
+                channel_model.trees = [
+                    [] for _ in range(max(channel_ptcs) + 1)
+                ]
+                for track, ptc in zip(tracks, channel_ptcs):
+                    channel_model.trees[ptc].append(track)
+
+                channel_models[i] = channel_model
+
+    return channel_models
+
+
 class Graph(object):
     """ Simple object for working with VPR RR graph.
 
@@ -220,6 +1431,7 @@ class Graph(object):
     serdes takes.
     """
 
+    @memory_phase('construction')
     def __init__(
             self,
             switches,
@@ -228,7 +1440,8 @@ class Graph(object):
             grid,
             nodes,
             edges=None,
-            build_pin_edges=True
+            build_pin_edges=True,
+            virtual_pin_edges=False,
     ):
         self.switches = switches
         self.next_switch_id = max(switch.id for switch in self.switches) + 1
@@ -258,9 +1471,20 @@ class Graph(object):
         self.grid = grid
 
         self.tracks = []
-        self.nodes = nodes
-        self.nodes.sort(key=lambda node: node.id)
-        self.edges = edges if edges is not None else []
+        if isinstance(nodes, NodeStore):
+            self.nodes = nodes
+        else:
+            self.nodes = NodeStore(nodes)
+        self.nodes.sort()
+        if isinstance(edges, EdgeStore):
+            self.edges = edges
+        else:
+            self.edges = EdgeStore(edges if edges is not None else ())
+
+        # CSR indices of edges by source and sink node, built on first use
+        # by fanout() and fanin().
+        self.fanout_index = None
+        self.fanin_index = None
 
         self.connection_boxes = []
         self.connection_box_map = {}
@@ -282,9 +1506,13 @@ class Graph(object):
 
         self.pin_ptc_to_name_map = {}
 
+        # Per block type map of pin name -> pin idx, indexed by block type id.
+        self.block_type_pin_ptcs = []
+
         # Create pin_name_map and sanity check block_types.
         for idx, block_type in enumerate(self.block_types):
             assert idx == block_type.id
+            self.block_type_pin_ptcs.append({})
             for pin_class_idx, pin_class in enumerate(block_type.pin_class):
                 for pin in pin_class.pin:
                     assert pin.name not in self.pin_name_map
@@ -292,67 +1520,181 @@ class Graph(object):
                         pin.name] = (block_type.id, pin_class_idx, pin.ptc)
                     self.pin_ptc_to_name_map[(block_type.id,
                                               pin.ptc)] = pin.name
+                    self.block_type_pin_ptcs[idx][pin.name] = pin.ptc
+
+        # Dense map of grid location to block type id, -1 where the grid has
+        # no location.  The block type at (x, y) is
+        # grid_block_type_ids[x * grid_height + y].
+        self.grid_width = max((loc.x + 1 for loc in grid), default=0)
+        self.grid_height = max((loc.y + 1 for loc in grid), default=0)
+        self.grid_block_type_ids = array(
+            'i', [-1]
+        ) * (self.grid_width * self.grid_height)
+        for loc in grid:
+            self.grid_block_type_ids[loc.x * self.grid_height +
+                                     loc.y] = loc.block_type_id
 
-        # Create mapping from grid locations and pins to nodes.
-        for idx, node in enumerate(self.nodes):
-            assert node.id == idx, (idx, node)
-
-            if node.type in (
-                    NodeType.IPIN,
-                    NodeType.OPIN,
-            ):
-                key = (node.loc.x_low, node.loc.y_low, node.loc.ptc)
-                if key not in self.loc_pin_map:
-                    self.loc_pin_map[key] = []
-                self.loc_pin_map[key].append((node.id, node.loc.side))
-
-            if node.type in (
-                    NodeType.SOURCE,
-                    NodeType.SINK,
-            ):
-                key = (node.loc.x_low, node.loc.y_low, node.loc.ptc)
-                assert key not in self.loc_pin_class_map, (
-                    node, self.loc_pin_class_map[key]
-                )
-                self.loc_pin_class_map[key] = node.id
+        self._build_loc_pin_maps()
+
+        # Pins of each pin class, resolved once per block type.
+        self._block_type_pins = [
+            [
+                (pin_class_idx, pin_class, [pin.ptc for pin in pin_class.pin])
+                for pin_class_idx, pin_class in enumerate(block_type.pin_class)
+            ] for block_type in self.block_types
+        ]
 
-        # Rebuild initial edges of IPIN -> SINK and SOURCE -> OPIN.
         for loc in grid:
             assert loc.block_type_id >= 0 and loc.block_type_id <= len(
                 self.block_types
             ), loc.block_type_id
-            block_type = self.block_types[loc.block_type_id]
 
             key = (loc.x, loc.y)
             assert key not in self.loc_map
             self.loc_map[key] = loc
 
-            for pin_class_idx, pin_class in enumerate(block_type.pin_class):
+            for pin_class_idx, _, _ in self._block_type_pins[loc.block_type_id
+                                                             ]:
+                assert (loc.x, loc.y, pin_class_idx) in \
+                    self.loc_pin_class_map, (loc, pin_class_idx)
+
+        # Rebuild initial edges of IPIN -> SINK and SOURCE -> OPIN.
+        #
+        # When virtual_pin_edges is set, these edges are not stored.  They
+        # are regenerated by iter_virtual_pin_edges when the graph is
+        # serialized.
+        self.virtual_pin_edges = build_pin_edges and virtual_pin_edges
+        self.num_virtual_pin_edges = 0
+
+        if self.virtual_pin_edges:
+            self.num_virtual_pin_edges = sum(
+                len(pin_nodes) for _, _, pin_nodes in self._pin_edge_groups()
+            )
+        elif build_pin_edges:
+            self.add_edges(*self._pin_edge_columns(), check=False)
+
+    def _pin_edge_columns(self):
+        """ Return the pin edges as (src_node, sink_node, switch_id) arrays. """
+        src_nodes = array('I')
+        sink_nodes = array('I')
+
+        for pin_class_type, pin_class_node, pin_nodes in \
+                self._pin_edge_groups():
+            if pin_class_type == PinType.OUTPUT:
+                src_nodes.extend(repeat(pin_class_node, len(pin_nodes)))
+                sink_nodes.extend(pin_nodes)
+            else:
+                src_nodes.extend(pin_nodes)
+                sink_nodes.extend(repeat(pin_class_node, len(pin_nodes)))
+
+        return (
+            src_nodes, sink_nodes,
+            array('I', [self.delayless_switch]) * len(src_nodes)
+        )
+
+    def _pin_edge_groups(self):
+        """ Yield the IPIN -> SINK and SOURCE -> OPIN edges of the grid.
+
+        Edges are grouped by pin class instance, yielding
+        (pin class type, pin class node, list of pin nodes), in grid order.
+        OUTPUT classes have edges from the pin class (SOURCE) node to each
+        pin node, INPUT classes from each pin node to the pin class (SINK)
+        node.
+
+        """
+        for loc in self.grid:
+            for pin_class_idx, pin_class, pin_ptcs in self._block_type_pins[
+                    loc.block_type_id]:
                 pin_class_node = self.loc_pin_class_map[
                     (loc.x, loc.y, pin_class_idx)]
 
-                # Skip building IPIN -> SINK and OPIN -> SOURCE graph if edges
-                # are not required.
-                if not build_pin_edges:
-                    continue
+                pin_nodes = [
+                    pin_node for ptc in pin_ptcs
+                    for pin_node, _ in self.loc_pin_map[(loc.x, loc.y, ptc)]
+                ]
 
-                for pin in pin_class.pin:
-                    for pin_node, _ in self.loc_pin_map[(loc.x, loc.y,
-                                                         pin.ptc)]:
-                        if pin_class.type == PinType.OUTPUT:
-                            self.add_edge(
-                                src_node=pin_class_node,
-                                sink_node=pin_node,
-                                switch_id=self.delayless_switch
-                            )
-                        elif pin_class.type == PinType.INPUT:
-                            self.add_edge(
-                                src_node=pin_node,
-                                sink_node=pin_class_node,
-                                switch_id=self.delayless_switch,
-                            )
-                        else:
-                            assert False, (loc, pin_class)
+                if len(pin_nodes) > 0:
+                    assert pin_class.type in (
+                        PinType.OUTPUT, PinType.INPUT
+                    ), (loc, pin_class)
+
+                yield pin_class.type, pin_class_node, pin_nodes
+
+    def iter_virtual_pin_edges(self):
+        """ Yield the pin edges that were not stored because of
+        virtual_pin_edges, as Edge tuples.
+
+        Serializers emit these edges before the edges they are given, which
+        is where the stored pin edges would be.  Yields nothing if
+        virtual_pin_edges is not set.
+
+        """
+        if not self.virtual_pin_edges:
+            return
+
+        switch_id = self.delayless_switch
+
+        for pin_class_type, pin_class_node, pin_nodes in \
+                self._pin_edge_groups():
+            if pin_class_type == PinType.OUTPUT:
+                for pin_node in pin_nodes:
+                    yield Edge(pin_class_node, pin_node, switch_id, None)
+            else:
+                for pin_node in pin_nodes:
+                    yield Edge(pin_node, pin_class_node, switch_id, None)
+
+    def virtual_pin_edge_store(self):
+        """ Return the virtual pin edges as a (temporary) EdgeStore.
+
+        The edges are the ones yielded by iter_virtual_pin_edges, in the same
+        order, for serializers that write edge columns in bulk.  Returns an
+        empty EdgeStore if virtual_pin_edges is not set.
+
+        """
+        edges = EdgeStore()
+        if self.virtual_pin_edges:
+            edges.add_edges(*self._pin_edge_columns())
+
+        return edges
+
+    def _build_loc_pin_maps(self):
+        """ Build loc_pin_map and loc_pin_class_map from the node columns.
+
+        Walks the type, location, ptc and side columns together, without
+        materializing any Node objects.
+
+        """
+        nodes = self.nodes
+
+        if nodes.id != array(nodes.id.typecode, range(len(nodes))):
+            for idx, node_id in enumerate(nodes.id):
+                assert node_id == idx, (idx, nodes[idx])
+
+        # Side lookup indexed by column value + 1, so _NULL_ENUM maps to None.
+        sides = (None, ) + _SIDES
+        assert _NULL_ENUM == -1
+
+        ipin, opin = NodeType.IPIN.value, NodeType.OPIN.value
+        source, sink = NodeType.SOURCE.value, NodeType.SINK.value
+
+        loc_pin_map = self.loc_pin_map
+        loc_pin_class_map = self.loc_pin_class_map
+
+        with _gc_paused():
+            for idx, (node_type, x_low, y_low, ptc, side) in enumerate(zip(
+                    nodes.type, nodes.x_low, nodes.y_low, nodes.ptc,
+                    nodes.side)):
+                if node_type == ipin or node_type == opin:
+                    key = (x_low, y_low, None if ptc == _NULL_INT else ptc)
+                    if key not in loc_pin_map:
+                        loc_pin_map[key] = []
+                    loc_pin_map[key].append((idx, sides[side + 1]))
+                elif node_type == source or node_type == sink:
+                    key = (x_low, y_low, None if ptc == _NULL_INT else ptc)
+                    assert key not in loc_pin_class_map, (
+                        nodes[idx], loc_pin_class_map[key]
+                    )
+                    loc_pin_class_map[key] = idx
 
     def maybe_add_connection_box(self, box):
         """ Get id for connection box name.
@@ -399,9 +1741,10 @@ class Graph(object):
             else:
                 timing = NodeTiming(r=0, c=0)
 
+        node_id = len(self.nodes)
         self.nodes.append(
             Node(
-                id=len(self.nodes),
+                id=node_id,
                 type=type,
                 direction=direction,
                 capacity=capacity,
@@ -414,7 +1757,7 @@ class Graph(object):
             )
         )
 
-        return self.nodes[-1].id
+        return node_id
 
     def get_segment_id_from_name(self, segment_name):
         return self.segment_name_map[segment_name]
@@ -479,21 +1822,153 @@ class Graph(object):
 
         return self.tracks[-1]
 
+    def add_padding_tracks(
+            self, direction, channel_models, min_value, max_value, segment_id
+    ):
+        """ Add capacity 0 tracks filling the gaps of packed channels.
+
+        All padding nodes are appended to the node store in one operation.
+
+        Arguments
+        ---------
+        direction : str
+            'X' or 'Y', direction of the channels.
+        channel_models : dict of int to channel2.Channel
+            Packed channel models, by channel coordinate.
+        min_value, max_value : int
+            Extent to fill, see channel2.Channel.fill_empty.
+        segment_id : int
+            Segment of the padding nodes.
+
+        Returns
+        -------
+        range of node ids of the padding nodes.
+
+        """
+        starts = array('h')
+        ends = array('h')
+        chans = array('h')
+        ptcs = array('i')
+
+        for chan, channel_model in channel_models.items():
+            for ptc, start, end in channel_model.fill_empty(min_value,
+                                                            max_value):
+                starts.append(start)
+                ends.append(end)
+                chans.append(chan)
+                ptcs.append(ptc)
+
+        if direction == 'X':
+            node_type = NodeType.CHANX
+            x_low, y_low, x_high, y_high = starts, chans, ends, chans
+        elif direction == 'Y':
+            node_type = NodeType.CHANY
+            x_low, y_low, x_high, y_high = chans, starts, chans, ends
+        else:
+            assert False, direction
+
+        node_ids = self.nodes.add_nodes(
+            x_low=x_low,
+            y_low=y_low,
+            x_high=x_high,
+            y_high=y_high,
+            ptc=ptcs,
+            type=node_type,
+            direction=NodeDirection.BI_DIR,
+            capacity=0,
+            side=None,
+            timing=NodeTiming(r=1, c=1),
+            segment=NodeSegment(segment_id=segment_id),
+        )
+        self.tracks.extend(node_ids)
+
+        return node_ids
+
     def create_pin_name_from_tile_type_and_pin(
             self, tile_type, port_name, pin_idx=0
     ):
         return '{}.{}[{}]'.format(tile_type, port_name, pin_idx)
 
+    def _block_type_id_at(self, x, y):
+        if 0 <= x < self.grid_width and 0 <= y < self.grid_height:
+            block_type_id = self.grid_block_type_ids[x * self.grid_height + y]
+            if block_type_id >= 0:
+                return block_type_id
+
+        raise KeyError((x, y))
+
+    def _pin_ptc(self, block_type_id, pin_name):
+        pin_ptcs = self.block_type_pin_ptcs[block_type_id]
+        if pin_name not in pin_ptcs:
+            # Unknown pins raise KeyError, pins of another block type assert.
+            pin_block_type_id, _, _ = self.pin_name_map[pin_name]
+            assert pin_block_type_id == block_type_id, (
+                pin_name, pin_block_type_id, block_type_id
+            )
+
+        return pin_ptcs[pin_name]
+
     def get_nodes_for_pin(self, loc, pin_name):
-        block_type_id, pin_class_idx, pin_idx = self.pin_name_map[pin_name]
-        grid_loc = self.loc_map[loc]
-        assert grid_loc.block_type_id == block_type_id
+        x, y = loc
+        block_type_id = self._block_type_id_at(x, y)
+        try:
+            ptc = self.block_type_pin_ptcs[block_type_id][pin_name]
+        except KeyError:
+            ptc = self._pin_ptc(block_type_id, pin_name)
 
-        return self.loc_pin_map[(loc[0], loc[1], pin_idx)]
+        return self.loc_pin_map[(x, y, ptc)]
 
-    def _create_edge(
-            self, src_node, sink_node, switch_id, name=None, value=''
-    ):
+    def get_nodes_for_pins(self, locs, pin_names):
+        """ Batched version of get_nodes_for_pin.
+
+        Arguments
+        ---------
+        locs : sequence of (x, y)
+        pin_names : sequence of str, parallel to locs
+
+        Returns
+        -------
+        node_ids, offsets : array.array
+            The nodes of the i-th pin are node_ids[offsets[i]:offsets[i+1]],
+            in the same order as returned by get_nodes_for_pin.
+
+        """
+        assert len(locs) == len(pin_names)
+
+        node_ids = []
+        offsets = [0]
+        node_ids_append = node_ids.append
+        offsets_append = offsets.append
+
+        grid_block_type_ids = self.grid_block_type_ids
+        grid_width = self.grid_width
+        grid_height = self.grid_height
+        block_type_pin_ptcs = self.block_type_pin_ptcs
+        loc_pin_map = self.loc_pin_map
+
+        for (x, y), pin_name in zip(locs, pin_names):
+            block_type_id = -1
+            if 0 <= x < grid_width and 0 <= y < grid_height:
+                block_type_id = grid_block_type_ids[x * grid_height + y]
+            if block_type_id < 0:
+                raise KeyError((x, y))
+
+            try:
+                ptc = block_type_pin_ptcs[block_type_id][pin_name]
+            except KeyError:
+                ptc = self._pin_ptc(block_type_id, pin_name)
+
+            for node, _ in loc_pin_map[(x, y, ptc)]:
+                node_ids_append(node)
+            offsets_append(len(node_ids))
+
+        return array('I', node_ids), array('I', offsets)
+
+    def add_edge(self, src_node, sink_node, switch_id, name=None, value=''):
+        """Add Edge to the graph
+
+        Appends a new edge to the graph and retruns the index in the edges list
+        """
         assert src_node >= 0 and src_node < len(self.nodes), src_node
         assert sink_node >= 0 and sink_node < len(self.nodes), sink_node
         assert switch_id >= 0 and switch_id < len(self.switches), switch_id
@@ -507,29 +1982,96 @@ class Graph(object):
         else:
             metadata = None
 
-        return Edge(
-            src_node=src_node,
-            sink_node=sink_node,
-            switch_id=switch_id,
-            metadata=metadata
-        )
+        return self.edges.add_edge(src_node, sink_node, switch_id, metadata)
 
-    def add_edge(self, src_node, sink_node, switch_id, name=None, value=''):
-        """Add Edge to the graph
+    def add_edges(
+            self, src_node, sink_node, switch_id, metadata=None, check=True
+    ):
+        """Add a batch of edges to the graph
 
-        Appends a new edge to the graph and retruns the index in the edges list
+        src_node, sink_node and switch_id are equal length sequences of ints,
+        typically NumPy arrays or other buffer protocol objects.  metadata is
+        an optional sequence of edge metadata parallel to the batch.
+
+        The whole batch is range checked at once against the current nodes
+        and switches.  Callers that already guarantee valid ids can pass
+        check=False to skip the check.
+
+        Returns the range of indices of the new edges in the edges list.
         """
-        self.edges.append(
-            self._create_edge(
-                src_node=src_node,
-                sink_node=sink_node,
-                switch_id=switch_id,
-                name=name,
-                value=value
-            )
+        src_node = _as_array('I', src_node)
+        sink_node = _as_array('I', sink_node)
+        switch_id = _as_array('I', switch_id)
+
+        assert len(src_node) == len(sink_node) == len(switch_id), (
+            len(src_node), len(sink_node), len(switch_id)
         )
 
-        return len(self.edges) - 1
+        if check and len(src_node) > 0:
+            assert max(src_node) < len(self.nodes), max(src_node)
+            assert max(sink_node) < len(self.nodes), max(sink_node)
+            assert max(switch_id) < len(self.switches), max(switch_id)
+
+        return self.edges.add_edges(
+            src_node, sink_node, switch_id, metadata=metadata
+        )
+
+    def fanout(self, node):
+        """ Return indices of edges whose src_node is node.
+
+        The index is built on first use, and picks up edges added since.
+        Only stored edges have indices, so the pin edges of a graph built
+        with virtual_pin_edges are not included, see iter_virtual_pin_edges.
+
+        """
+        if self.fanout_index is None or \
+                self.fanout_index.keys is not self.edges.src_node:
+            self.fanout_index = EdgeIndex(self.edges.src_node, len(self.nodes))
+
+        return self.fanout_index.edges(node)
+
+    def fanin(self, node):
+        """ Return indices of edges whose sink_node is node.
+
+        The index is built on first use, and picks up edges added since.
+        Virtual pin edges are not included, see fanout.
+
+        """
+        if self.fanin_index is None or \
+                self.fanin_index.keys is not self.edges.sink_node:
+            self.fanin_index = EdgeIndex(self.edges.sink_node, len(self.nodes))
+
+        return self.fanin_index.edges(node)
+
+    def sort_and_dedup_edges(
+            self,
+            order='src',
+            keep_first_metadata=True,
+            max_edges_in_memory=None,
+            scratch_dir=None
+    ):
+        """ Sort edges and remove duplicates, see EdgeStore.sort_and_dedup.
+
+        Edge indices change, so previously returned edge indices are no
+        longer valid.  Returns the number of edges removed.
+
+        The fanout and fanin indexes are dropped first, so the old edge
+        columns are not kept alive by them.
+
+        Only stored edges are sorted.  Virtual pin edges (see
+        iter_virtual_pin_edges) are unique, and are still written before
+        the stored edges.
+
+        """
+        self.fanout_index = None
+        self.fanin_index = None
+
+        return self.edges.sort_and_dedup(
+            order=order,
+            keep_first_metadata=keep_first_metadata,
+            max_edges_in_memory=max_edges_in_memory,
+            scratch_dir=scratch_dir,
+        )
 
     def add_switch(self, switch):
         """ Inner add_switch method.  Do not invoke directly.
@@ -553,88 +2095,117 @@ class Graph(object):
         return switch.id
 
     def check_ptc(self):
-        for node in self.nodes:
+        if _NULL_INT in self.nodes.ptc:
+            node = self.nodes[self.nodes.ptc.index(_NULL_INT)]
             assert node.loc.ptc is not None, node
 
     def set_track_ptc(self, track, ptc):
-        node_d = self.nodes[track]._asdict()
-        loc_d = self.nodes[track].loc._asdict()
-        assert loc_d['ptc'] is None
-        loc_d['ptc'] = ptc
-        node_d['loc'] = NodeLoc(**loc_d)
+        assert self.nodes.ptc[track] == _NULL_INT, self.nodes[track]
+        self.nodes.ptc[track] = ptc
+
+    def assign_ptcs(self, track_ids, ptcs):
+        """ Set the ptc of many tracks at once.
+
+        Equivalent to calling set_track_ptc for each pair of track_ids and
+        ptcs, but writes straight into the ptc column of the node store.
+
+        """
+        ptc_column = self.nodes.ptc
+
+        for track, ptc in zip(track_ids, ptcs):
+            assert ptc_column[track] == _NULL_INT, self.nodes[track]
+            ptc_column[track] = ptc
+
+    @memory_phase('create_channels')
+    def create_channels(self, pad_segment, pool=None, num_chunks=None):
+        """ Pack tracks into channels and return Channels definition for tracks.
 
-        self.nodes[track] = Node(**node_d)
+        If pool (a multiprocessing.Pool) is provided, channels are packed in
+        the pool in num_chunks chunks, see pack_channels_in_pool.  The result
+        is identical to packing without a pool.
 
-    def create_channels(self, pad_segment, pool=None):
-        """ Pack tracks into channels and return Channels definition for tracks."""
+        """
         assert len(self.tracks) > 0
 
+        # Read track locations from the node columns directly, rather than
+        # materializing a Node per track.
+        node_type = self.nodes.type
+        x_low = self.nodes.x_low
+        y_low = self.nodes.y_low
+        x_high = self.nodes.x_high
+        y_high = self.nodes.y_high
+
         xs = []
         ys = []
 
         for track in self.tracks:
-            track_node = self.nodes[track]
-
-            xs.append(track_node.loc.x_low)
-            xs.append(track_node.loc.x_high)
-            ys.append(track_node.loc.y_low)
-            ys.append(track_node.loc.y_high)
+            xs.append(x_low[track])
+            xs.append(x_high[track])
+            ys.append(y_low[track])
+            ys.append(y_high[track])
 
         x_tracks = {}
         y_tracks = {}
 
         for track in self.tracks:
-            track_node = self.nodes[track]
+            track_type = node_type[track]
 
-            if track_node.type == NodeType.CHANX:
-                assert track_node.loc.y_low == track_node.loc.y_high
+            if track_type == NodeType.CHANX.value:
+                assert y_low[track] == y_high[track], self.nodes[track]
 
-                x1, x2 = sorted((track_node.loc.x_low, track_node.loc.x_high))
+                x1, x2 = sorted((x_low[track], x_high[track]))
 
-                if track_node.loc.y_low not in x_tracks:
-                    x_tracks[track_node.loc.y_low] = []
+                if y_low[track] not in x_tracks:
+                    x_tracks[y_low[track]] = []
 
-                x_tracks[track_node.loc.y_low].append((x1, x2, track))
-            elif track_node.type == NodeType.CHANY:
-                assert track_node.loc.x_low == track_node.loc.x_high
+                x_tracks[y_low[track]].append((x1, x2, track))
+            elif track_type == NodeType.CHANY.value:
+                assert x_low[track] == x_high[track], self.nodes[track]
 
-                y1, y2 = sorted((track_node.loc.y_low, track_node.loc.y_high))
+                y1, y2 = sorted((y_low[track], y_high[track]))
 
-                if track_node.loc.x_low not in y_tracks:
-                    y_tracks[track_node.loc.x_low] = []
+                if x_low[track] not in y_tracks:
+                    y_tracks[x_low[track]] = []
 
-                y_tracks[track_node.loc.x_low].append((y1, y2, track))
+                y_tracks[x_low[track]].append((y1, y2, track))
             else:
-                assert False, track_node
+                assert False, self.nodes[track]
 
         x_list = []
         y_list = []
 
+        track_ids = []
+        ptcs = []
+
         x_channel_models = {}
         y_channel_models = {}
 
         if pool is not None:
-            for y in x_tracks:
-                x_channel_models[y] = pool.apply_async(
-                    process_track, (x_tracks[y], )
-                )
+            x_keys = sorted(x_tracks)
+            y_keys = sorted(y_tracks)
 
-            for x in y_tracks:
-                y_channel_models[x] = pool.apply_async(
-                    process_track, (y_tracks[x], )
-                )
+            channel_models = pack_channels_in_pool(
+                [x_tracks[y] for y in x_keys] + [y_tracks[x] for x in y_keys],
+                pool,
+                num_chunks=num_chunks,
+            )
+
+            x_channel_models = dict(
+                zip(x_keys, channel_models[:len(x_keys)])
+            )
+            y_channel_models = dict(
+                zip(y_keys, channel_models[len(x_keys):])
+            )
 
         for y in progressbar_utils.progressbar(range(max(x_tracks) + 1)):
             if y in x_tracks:
                 if pool is None:
                     x_channel_models[y] = process_track(x_tracks[y])
-                else:
-                    x_channel_models[y] = x_channel_models[y].get()
 
                 x_list.append(len(x_channel_models[y].trees))
                 for idx, tree in enumerate(x_channel_models[y].trees):
-                    for i in tree:
-                        self.set_track_ptc(track=i[2], ptc=idx)
+                    track_ids.extend(i[2] for i in tree)
+                    ptcs.extend(repeat(idx, len(tree)))
             else:
                 x_list.append(0)
 
@@ -642,57 +2213,28 @@ class Graph(object):
             if x in y_tracks:
                 if pool is None:
                     y_channel_models[x] = process_track(y_tracks[x])
-                else:
-                    y_channel_models[x] = y_channel_models[x].get()
 
                 y_list.append(len(y_channel_models[x].trees))
                 for idx, tree in enumerate(y_channel_models[x].trees):
-                    for i in tree:
-                        self.set_track_ptc(track=i[2], ptc=idx)
+                    track_ids.extend(i[2] for i in tree)
+                    ptcs.extend(repeat(idx, len(tree)))
             else:
                 y_list.append(0)
 
+        self.assign_ptcs(track_ids, ptcs)
+
         x_min = min(xs)
         y_min = min(ys)
         x_max = max(xs)
         y_max = max(ys)
 
-        num_padding = 0
-        for chan, channel_model in x_channel_models.items():
-            for ptc, start, end in channel_model.fill_empty(max(x_min, 1),
-                                                            x_max):
-                num_padding += 1
-                self.add_track(
-                    track=Track(
-                        direction='X',
-                        x_low=start,
-                        y_low=chan,
-                        x_high=end,
-                        y_high=chan,
-                    ),
-                    segment_id=pad_segment,
-                    capacity=0,
-                    timing=None,
-                    ptc=ptc
-                )
-
-        for chan, channel_model in y_channel_models.items():
-            for ptc, start, end in channel_model.fill_empty(max(y_min, 1),
-                                                            y_max):
-                num_padding += 1
-                self.add_track(
-                    track=Track(
-                        direction='Y',
-                        x_low=chan,
-                        y_low=start,
-                        x_high=chan,
-                        y_high=end,
-                    ),
-                    segment_id=pad_segment,
-                    capacity=0,
-                    timing=None,
-                    ptc=ptc
-                )
+        x_padding = self.add_padding_tracks(
+            'X', x_channel_models, max(x_min, 1), x_max, pad_segment
+        )
+        y_padding = self.add_padding_tracks(
+            'Y', y_channel_models, max(y_min, 1), y_max, pad_segment
+        )
+        num_padding = len(x_padding) + len(y_padding)
 
         print('Number padding nodes {}'.format(num_padding))
 
@@ -706,6 +2248,59 @@ class Graph(object):
             y_list=[ChannelList(idx, info) for idx, info in enumerate(y_list)],
         )
 
+    def memory_report(self, channels=None):
+        """ Estimate the memory used by the major structures of the graph.
+
+        Objects shared between structures are counted only in the first
+        structure reported.  Walking every object of a large graph takes a
+        while, so this is meant for diagnostics only.
+
+        Arguments
+        ---------
+        channels : Channels, optional
+            The result of create_channels, reported as "channels".
+
+        Returns
+        -------
+        dict of str to int
+            Estimated deep size in bytes, keyed by attribute name, plus
+            "total".
+
+        """
+        names = (
+            'nodes',
+            'edges',
+            'fanout_index',
+            'fanin_index',
+            'tracks',
+            'loc_map',
+            'loc_pin_map',
+            'loc_pin_class_map',
+            'pin_name_map',
+            'pin_ptc_to_name_map',
+            'block_type_pin_ptcs',
+            'grid_block_type_ids',
+            '_block_type_pins',
+            'connection_boxes',
+            'connection_box_map',
+            'switches',
+            'segments',
+            'block_types',
+            'grid',
+        )
+
+        seen = set()
+        report = {}
+        for name in names:
+            report[name] = _deep_sizeof(getattr(self, name), seen)
+
+        if channels is not None:
+            report['channels'] = _deep_sizeof(channels, seen)
+
+        report['total'] = sum(report.values())
+
+        return report
+
     def block_type_at_loc(self, loc):
         return self.block_types[self.loc_map[loc].block_type_id].name
 
@@ -713,4 +2308,136 @@ class Graph(object):
         return self.switch_name_map[switch_name]
 
     def sort_nodes(self):
-        self.nodes.sort(key=lambda node: node.id)
+        self.nodes.sort()
+
+    def save_snapshot(self, path):
+        """ Save the graph to a binary snapshot file, see load_snapshot.
+
+        Node and edge columns are written as raw arrays, everything else
+        (switches, segments, block types, grid, tracks and the lookup maps)
+        is pickled.
+
+        """
+        state = dict(self.__dict__)
+
+        # Edge indexes are rebuilt on first use.
+        state['fanout_index'] = None
+        state['fanin_index'] = None
+
+        stores = {}
+        with open(path, 'wb') as f:
+            f.write(bytes(_SNAPSHOT_PREFIX.size))
+            for name in ('nodes', 'edges'):
+                stores[name] = _write_store_columns(f, state.pop(name))
+
+            header = pickle.dumps(
+                {
+                    'byteorder': sys.byteorder,
+                    'stores': stores,
+                    'state': state,
+                },
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+            header_offset = f.tell()
+            f.write(header)
+
+            f.seek(0)
+            f.write(
+                _SNAPSHOT_PREFIX.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION, header_offset,
+                    len(header)
+                )
+            )
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """ Fast load of a graph saved with save_snapshot.
+
+        Each node and edge column is read from the file in one block, so no
+        per node or per edge work is done, and the lookup maps are unpickled
+        rather than rebuilt.  This is not a memory mapped (zero-copy) load:
+        the loaded graph is an ordinary, mutable in-memory graph, and takes
+        as much memory as the graph that was saved.
+
+        """
+        with open(path, 'rb') as f:
+            magic, version, header_offset, header_size = \
+                _SNAPSHOT_PREFIX.unpack(f.read(_SNAPSHOT_PREFIX.size))
+            assert magic == SNAPSHOT_MAGIC, path
+            assert version == SNAPSHOT_VERSION, (path, version)
+
+            f.seek(header_offset)
+            header_bytes = f.read(header_size)
+            with _gc_paused():
+                header = pickle.loads(header_bytes)
+            del header_bytes
+
+            graph = cls.__new__(cls)
+            graph.__dict__.update(header['state'])
+            graph.nodes = _read_store_columns(
+                NodeStore(), f, header['stores']['nodes'],
+                header['byteorder']
+            )
+            graph.edges = _read_store_columns(
+                EdgeStore(), f, header['stores']['edges'],
+                header['byteorder']
+            )
+
+        return graph
+
+    def compute_node_remap(self, order='hilbert'):
+        """ Compute a locality preserving renumbering of the nodes.
+
+        Nodes are ordered by the Hilbert curve index of (x_low, y_low) if
+        order is 'hilbert', or by (type, x_low, y_low) if order is
+        'type_loc'.  Nodes with the same key keep their relative order, and
+        for 'hilbert' nodes at the same location are grouped by type.
+
+        Returns
+        -------
+        array.array('I')
+            remap[old_node_id] is the new node id.  It can be passed as
+            node_remap to the serializers.
+
+        """
+        nodes = self.nodes
+        num_nodes = len(nodes)
+        assert num_nodes < (1 << 32)
+
+        if num_nodes == 0:
+            return array('I')
+
+        # Coordinates are relative to the minimum, so they fit in 16 bits.
+        x_min = min(nodes.x_low)
+        y_min = min(nodes.y_low)
+        xs = [x - x_min for x in nodes.x_low]
+        ys = [y - y_min for y in nodes.y_low]
+
+        if order == 'hilbert':
+            curve_order = max(max(xs), max(ys), 1).bit_length()
+            location_index = {}
+            keys = []
+            for x, y, node_type, idx in zip(xs, ys, nodes.type,
+                                            range(num_nodes)):
+                loc = x << 16 | y
+                h = location_index.get(loc)
+                if h is None:
+                    h = location_index[loc] = hilbert_index(x, y, curve_order)
+                keys.append(h << 40 | node_type << 32 | idx)
+        elif order == 'type_loc':
+            keys = [
+                node_type << 64 | x << 48 | y << 32 | idx
+                for node_type, x, y, idx in zip(
+                    nodes.type, xs, ys, range(num_nodes)
+                )
+            ]
+        else:
+            assert False, order
+
+        keys.sort()
+
+        remap = array('I', bytes(4 * num_nodes))
+        for new_id, key in enumerate(keys):
+            remap[key & 0xFFFFFFFF] = new_id
+
+        return remap
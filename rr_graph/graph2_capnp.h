@@ -1,8 +1,90 @@
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <vector>
+
 #include <capnp/message.h>
+#include <capnp/serialize.h>
+#include <capnp/serialize-packed.h>
+#include <kj/io.h>
 #include "rr_graph_uxsdcxx.capnp.h"
 
 namespace graph2 {
 
+class RrNodesInserter {
+public:
+    RrNodesInserter(::capnp::MessageBuilder *base, unsigned int num_nodes)
+        : builder_(base->getRoot<ucap::RrGraph>().getRrNodes())
+        , nodes_(builder_.initNodes(num_nodes)) {}
+
+    // Enum arguments are capnp enumerant ordinals, direction and side are
+    // left unset when negative.
+    void add_node(
+            unsigned int index, unsigned int id, unsigned int type,
+            int direction, unsigned int capacity,
+            int x_low, int y_low, int x_high, int y_high, int ptc, int side) {
+        auto node = nodes_[index];
+        node.setId(id);
+        node.setType(static_cast<ucap::NodeType>(type));
+        node.setCapacity(capacity);
+        if (direction >= 0) {
+            node.setDirection(static_cast<ucap::NodeDirection>(direction));
+        }
+
+        auto loc = node.initLoc();
+        loc.setPtc(ptc);
+        if (side >= 0) {
+            loc.setSide(static_cast<ucap::LocSide>(side));
+        }
+        loc.setXhigh(x_high);
+        loc.setXlow(x_low);
+        loc.setYhigh(y_high);
+        loc.setYlow(y_low);
+    }
+
+    void set_timing(unsigned int index, double r, double c) {
+        auto timing = nodes_[index].initTiming();
+        timing.setC(c);
+        timing.setR(r);
+    }
+
+    void set_segment(unsigned int index, unsigned int segment_id) {
+        nodes_[index].initSegment().setSegmentId(segment_id);
+    }
+
+    void init_metas(unsigned int index, unsigned int num_metas) {
+        nodes_[index].initMetadata().initMetas(num_metas);
+    }
+
+    void set_meta(
+            unsigned int index, unsigned int meta_index,
+            const std::string &name, const std::string &value) {
+        auto meta = nodes_[index].getMetadata().getMetas()[meta_index];
+        meta.setName(::capnp::Text::Reader(name.data(), name.size()));
+        meta.setValue(::capnp::Text::Reader(value.data(), value.size()));
+    }
+
+    void set_canonical_loc(unsigned int index, int x, int y) {
+        auto canonical_loc = nodes_[index].initCanonicalLoc();
+        canonical_loc.setX(x);
+        canonical_loc.setY(y);
+    }
+
+    void set_connection_box(
+            unsigned int index, unsigned int id, int x, int y,
+            double site_pin_delay) {
+        auto connection_box = nodes_[index].initConnectionBox();
+        connection_box.setId(id);
+        connection_box.setX(x);
+        connection_box.setY(y);
+        connection_box.setSitePinDelay(site_pin_delay);
+    }
+private:
+    ucap::RrNodes::Builder builder_;
+    ::capnp::List< ::ucap::Node,  ::capnp::Kind::STRUCT>::Builder nodes_;
+
+};
+
 class RrEdgesInserter {
 public:
     RrEdgesInserter(::capnp::MessageBuilder *base, unsigned int num_edges)
@@ -17,10 +99,181 @@ public:
         edge.setSinkNode(sink_node);
         edge.setSwitchId(switch_id);
     }
+
+    // Set edges [first, first + count) from edge columns, mapping nodes
+    // through node_remap unless it is null.  Does not touch any Python
+    // object, so it can run without the GIL.
+    void add_edges(
+            unsigned int first, size_t count,
+            const unsigned int *src_nodes, const unsigned int *sink_nodes,
+            const unsigned int *switch_ids, const unsigned int *node_remap) {
+        for (size_t i = 0; i < count; ++i) {
+            unsigned int src_node = src_nodes[i];
+            unsigned int sink_node = sink_nodes[i];
+            if (node_remap != nullptr) {
+                src_node = node_remap[src_node];
+                sink_node = node_remap[sink_node];
+            }
+            add_edge(first + i, src_node, sink_node, switch_ids[i]);
+        }
+    }
+
+    void init_metas(unsigned int index, unsigned int num_metas) {
+        edges_[index].initMetadata().initMetas(num_metas);
+    }
+
+    void set_meta(
+            unsigned int index, unsigned int meta_index,
+            const std::string &name, const std::string &value) {
+        auto meta = edges_[index].getMetadata().getMetas()[meta_index];
+        meta.setName(::capnp::Text::Reader(name.data(), name.size()));
+        meta.setValue(::capnp::Text::Reader(value.data(), value.size()));
+    }
 private:
     ucap::RrEdges::Builder builder_;
     ::capnp::List< ::ucap::Edge,  ::capnp::Kind::STRUCT>::Builder edges_;
 
 };
 
+class RrGraphDecoder {
+public:
+    // Read the RrGraph message in data (size bytes), in the packed encoding
+    // if packed.  The message is read with the compiled-in schema, through
+    // MessageReader::getRoot, so data must outlive the decoder.
+    RrGraphDecoder(const unsigned char *data, size_t size, bool packed) {
+        ::capnp::ReaderOptions options;
+        options.traversalLimitInWords = kj::maxValue;
+
+        auto bytes = kj::arrayPtr(
+            reinterpret_cast<const kj::byte *>(data), size);
+        if (packed) {
+            input_ = kj::heap<kj::ArrayInputStream>(bytes);
+            message_ = kj::heap<::capnp::PackedMessageReader>(
+                *input_, options);
+        } else {
+            KJ_REQUIRE(size % sizeof(::capnp::word) == 0,
+                       "capnp message size is not a multiple of words", size);
+
+            const ::capnp::word *words =
+                reinterpret_cast<const ::capnp::word *>(data);
+            if (reinterpret_cast<uintptr_t>(data) % alignof(::capnp::word) != 0) {
+                aligned_ = kj::heapArray<::capnp::word>(
+                    size / sizeof(::capnp::word));
+                memcpy(aligned_.begin(), data, size);
+                words = aligned_.begin();
+            }
+
+            message_ = kj::heap<::capnp::FlatArrayMessageReader>(
+                kj::arrayPtr(words, size / sizeof(::capnp::word)), options);
+        }
+
+        graph_ = message_->getRoot<ucap::RrGraph>();
+    }
+
+    size_t num_nodes() const {
+        return graph_.getRrNodes().getNodes().size();
+    }
+
+    size_t num_edges() const {
+        return graph_.getRrEdges().getEdges().size();
+    }
+
+    // Decode nodes into NodeStore columns, which must have room for
+    // num_nodes() nodes.  Nodes whose capnp type ordinal has a zero
+    // keep_types entry are skipped.  Enums are converted from capnp
+    // ordinals with the *_codes tables, which have an entry per enumerant of
+    // the schema.  If rebase_nodes, node ids are the index of the node in
+    // the columns.  Returns the number of nodes decoded.
+    size_t decode_nodes(
+            const unsigned char *keep_types, const int *type_codes,
+            const int *direction_codes, const int *side_codes,
+            bool rebase_nodes, int *ids, signed char *types,
+            signed char *directions, int *capacities,
+            short *x_lows, short *y_lows, short *x_highs, short *y_highs,
+            signed char *sides, int *ptcs, double *rs, double *cs,
+            int *segment_ids) const {
+        size_t count = 0;
+        for (auto node : graph_.getRrNodes().getNodes()) {
+            auto type = static_cast<unsigned int>(node.getType());
+            if (!keep_types[type]) {
+                continue;
+            }
+
+            ids[count] = rebase_nodes ? count : node.getId();
+            types[count] = type_codes[type];
+            directions[count] = direction_codes[
+                static_cast<unsigned int>(node.getDirection())];
+            capacities[count] = node.getCapacity();
+
+            auto loc = node.getLoc();
+            x_lows[count] = loc.getXlow();
+            y_lows[count] = loc.getYlow();
+            x_highs[count] = loc.getXhigh();
+            y_highs[count] = loc.getYhigh();
+            sides[count] = side_codes[static_cast<unsigned int>(loc.getSide())];
+            ptcs[count] = loc.getPtc();
+
+            auto timing = node.getTiming();
+            rs[count] = timing.getR();
+            cs[count] = timing.getC();
+
+            segment_ids[count] = node.getSegment().getSegmentId();
+
+            count += 1;
+        }
+
+        return count;
+    }
+
+    // Decode edges [first, last) into EdgeStore columns, which must have
+    // room for last - first edges.  If src_filter (sink_filter) is not null,
+    // only edges whose src (sink) node has a non-zero entry in it are
+    // decoded, node ids past src_filter_size (sink_filter_size) don't
+    // match.  If edge_ids is not null, the index of each decoded edge is
+    // written to it.  The column positions of decoded edges with metadata
+    // are appended to with_metadata.  Returns the number of edges decoded.
+    size_t decode_edges(
+            size_t first, size_t last,
+            const unsigned char *src_filter, size_t src_filter_size,
+            const unsigned char *sink_filter, size_t sink_filter_size,
+            unsigned int *src_nodes, unsigned int *sink_nodes,
+            unsigned int *switch_ids, unsigned int *edge_ids,
+            std::vector<unsigned int> *with_metadata) const {
+        auto edges = graph_.getRrEdges().getEdges();
+        size_t count = 0;
+        for (size_t idx = first; idx < last; ++idx) {
+            auto edge = edges[idx];
+            unsigned int src_node = edge.getSrcNode();
+            unsigned int sink_node = edge.getSinkNode();
+            if (src_filter != nullptr && (
+                    src_node >= src_filter_size || !src_filter[src_node])) {
+                continue;
+            }
+            if (sink_filter != nullptr && (
+                    sink_node >= sink_filter_size || !sink_filter[sink_node])) {
+                continue;
+            }
+
+            src_nodes[count] = src_node;
+            sink_nodes[count] = sink_node;
+            switch_ids[count] = edge.getSwitchId();
+            if (edge_ids != nullptr) {
+                edge_ids[count] = idx;
+            }
+            if (edge.hasMetadata() && edge.getMetadata().getMetas().size() > 0) {
+                with_metadata->push_back(count);
+            }
+
+            count += 1;
+        }
+
+        return count;
+    }
+private:
+    kj::Own<kj::ArrayInputStream> input_;
+    kj::Array<::capnp::word> aligned_;
+    kj::Own<::capnp::MessageReader> message_;
+    ucap::RrGraph::Reader graph_;
+};
+
 } // namespace graph2
@@ -4,22 +4,394 @@
 # cython: c_string_type = str
 # cython: c_string_encoding = default
 # cython: embedsignature = True
+from array import array
+from libcpp cimport bool
+from libcpp.string cimport string
+from libcpp.vector cimport vector
 from capnp.includes.schema_cpp cimport MessageBuilder
 from capnp.lib.capnp cimport _MessageBuilder
 
 cdef extern from "rr_graph/graph2_capnp.h" namespace "graph2":
+    cdef cppclass RrNodesInserter:
+        RrNodesInserter(MessageBuilder*, unsigned int) except +
+        void add_node(unsigned int index, unsigned int id, unsigned int type, int direction, unsigned int capacity, int x_low, int y_low, int x_high, int y_high, int ptc, int side) except + nogil
+        void set_timing(unsigned int index, double r, double c) except + nogil
+        void set_segment(unsigned int index, unsigned int segment_id) except + nogil
+        void init_metas(unsigned int index, unsigned int num_metas) except +
+        void set_meta(unsigned int index, unsigned int meta_index, const string &name, const string &value) except +
+        void set_canonical_loc(unsigned int index, int x, int y) except +
+        void set_connection_box(unsigned int index, unsigned int id, int x, int y, double site_pin_delay) except +
+
     cdef cppclass RrEdgesInserter:
-        RrEdgesInserter(MessageBuilder*, unsigned int)
-        void add_edge(unsigned int index, unsigned int src_node, unsigned int sink_node, unsigned int switch_id)
+        RrEdgesInserter(MessageBuilder*, unsigned int) except +
+        void add_edge(unsigned int index, unsigned int src_node, unsigned int sink_node, unsigned int switch_id) except +
+        void add_edges(unsigned int first, size_t count, const unsigned int *src_nodes, const unsigned int *sink_nodes, const unsigned int *switch_ids, const unsigned int *node_remap) except + nogil
+        void init_metas(unsigned int index, unsigned int num_metas) except +
+        void set_meta(unsigned int index, unsigned int meta_index, const string &name, const string &value) except +
+
+    cdef cppclass RrGraphDecoder:
+        RrGraphDecoder(const unsigned char *data, size_t size, bool packed) except +
+        size_t num_nodes() except +
+        size_t num_edges() except +
+        size_t decode_nodes(const unsigned char *keep_types, const int *type_codes, const int *direction_codes, const int *side_codes, bool rebase_nodes, int *ids, signed char *types, signed char *directions, int *capacities, short *x_lows, short *y_lows, short *x_highs, short *y_highs, signed char *sides, int *ptcs, double *rs, double *cs, int *segment_ids) except + nogil
+        size_t decode_edges(size_t first, size_t last, const unsigned char *src_filter, size_t src_filter_size, const unsigned char *sink_filter, size_t sink_filter_size, unsigned int *src_nodes, unsigned int *sink_nodes, unsigned int *switch_ids, unsigned int *edge_ids, vector[unsigned int] *with_metadata) except + nogil
+
+# Sentinel of NodeStore ptc and segment_id columns for None.
+cdef int NULL_INT = -(1 << 31)
+
+cdef class _RrNodesInserter:
+    cdef RrNodesInserter *c_nodes
+    cdef unsigned int num_nodes
+
+    def __cinit__(self, _MessageBuilder builder, unsigned int num_nodes):
+        self.c_nodes = new RrNodesInserter(builder.thisptr, num_nodes)
+        self.num_nodes = num_nodes
+
+    def __dealloc__(self):
+        del self.c_nodes
+
+    def add_nodes(
+            self,
+            const unsigned int[:] ids,
+            const signed char[:] types,
+            const signed char[:] directions,
+            const int[:] capacities,
+            const short[:] x_lows,
+            const short[:] y_lows,
+            const short[:] x_highs,
+            const short[:] y_highs,
+            const signed char[:] sides,
+            const int[:] ptcs,
+            const double[:] rs,
+            const double[:] cs,
+            const int[:] segment_ids,
+            const int[:] type_codes,
+            const int[:] direction_codes,
+            const int[:] side_codes):
+        """ Write nodes from NodeStore style columns.
+
+        type_codes, direction_codes and side_codes map the graph2 enum values
+        stored in the columns to capnp enumerant ordinals.  Negative
+        directions and sides are left unset, NaN r (no timing) and NULL_INT
+        segment ids are skipped.
+
+        """
+        cdef Py_ssize_t idx
+        cdef Py_ssize_t num_nodes = ids.shape[0]
+        cdef int direction
+        cdef int side
+
+        assert num_nodes == self.num_nodes
+        assert types.shape[0] == num_nodes
+        assert directions.shape[0] == num_nodes
+        assert capacities.shape[0] == num_nodes
+        assert x_lows.shape[0] == num_nodes
+        assert y_lows.shape[0] == num_nodes
+        assert x_highs.shape[0] == num_nodes
+        assert y_highs.shape[0] == num_nodes
+        assert sides.shape[0] == num_nodes
+        assert ptcs.shape[0] == num_nodes
+        assert rs.shape[0] == num_nodes
+        assert cs.shape[0] == num_nodes
+        assert segment_ids.shape[0] == num_nodes
+
+        with nogil:
+            for idx in range(num_nodes):
+                direction = -1
+                if directions[idx] >= 0:
+                    direction = direction_codes[directions[idx]]
+                side = -1
+                if sides[idx] >= 0:
+                    side = side_codes[sides[idx]]
+
+                self.c_nodes.add_node(
+                    idx, ids[idx], type_codes[types[idx]], direction,
+                    capacities[idx], x_lows[idx], y_lows[idx], x_highs[idx],
+                    y_highs[idx], ptcs[idx], side)
+
+                if rs[idx] == rs[idx]:
+                    self.c_nodes.set_timing(idx, rs[idx], cs[idx])
+
+                if segment_ids[idx] != NULL_INT:
+                    self.c_nodes.set_segment(idx, segment_ids[idx])
+
+    def set_metadata(self, unsigned int index, metadata):
+        """ Write node metadata, NodeMetadata or (name, value) tuples. """
+        assert index < self.num_nodes
+        self.c_nodes.init_metas(index, len(metadata))
+        for meta_index, meta in enumerate(metadata):
+            if isinstance(meta, tuple) and len(meta) == 2:
+                name, value = meta
+            else:
+                name, value = meta.name, meta.value
+            self.c_nodes.set_meta(index, meta_index, name, value)
+
+    def set_canonical_loc(self, unsigned int index, int x, int y):
+        self.c_nodes.set_canonical_loc(index, x, y)
+
+    def set_connection_box(self, unsigned int index, unsigned int id, int x, int y, double site_pin_delay):
+        self.c_nodes.set_connection_box(index, id, x, y, site_pin_delay)
 
 cdef class _RrEdgesInserter:
     cdef RrEdgesInserter *c_edges
+    cdef unsigned int num_edges
+    cdef const unsigned int[::1] node_remap
+    cdef bint has_node_remap
 
-    def __cinit__(self, _MessageBuilder builder, unsigned int num_edges):
+    def __cinit__(self, _MessageBuilder builder, unsigned int num_edges, node_remap=None):
+        """ node_remap is an optional buffer of new node ids (uint32), indexed
+        by the node ids passed to add_edge. """
         self.c_edges = new RrEdgesInserter(builder.thisptr, num_edges)
+        self.num_edges = num_edges
+        self.has_node_remap = node_remap is not None
+        if self.has_node_remap:
+            self.node_remap = node_remap
 
     def __dealloc__(self):
         del self.c_edges
 
     def add_edge(self, unsigned int index, unsigned int src_node, unsigned int sink_node, unsigned int switch_id):
+        assert index < self.num_edges
+        if self.has_node_remap:
+            src_node = self.node_remap[src_node]
+            sink_node = self.node_remap[sink_node]
         self.c_edges.add_edge(index, src_node, sink_node, switch_id)
+
+    def add_edges(self, unsigned int first, const unsigned int[::1] src_nodes, const unsigned int[::1] sink_nodes, const unsigned int[::1] switch_ids):
+        """ Set edges first, first + 1, ... from contiguous uint32 buffers.
+
+        The buffers may be array('I'), memoryviews or NumPy uint32 arrays.
+        All edges are written in one C++ loop with the GIL released.
+
+        """
+        cdef size_t count = src_nodes.shape[0]
+        cdef size_t idx
+        cdef unsigned int max_node = 0
+        cdef const unsigned int *node_remap = NULL
+
+        assert sink_nodes.shape[0] == count
+        assert switch_ids.shape[0] == count
+        assert first + count <= self.num_edges
+
+        if count == 0:
+            return
+
+        if self.has_node_remap:
+            with nogil:
+                for idx in range(count):
+                    if src_nodes[idx] > max_node:
+                        max_node = src_nodes[idx]
+                    if sink_nodes[idx] > max_node:
+                        max_node = sink_nodes[idx]
+            assert max_node < self.node_remap.shape[0], max_node
+            node_remap = &self.node_remap[0]
+
+        with nogil:
+            self.c_edges.add_edges(
+                first, count, &src_nodes[0], &sink_nodes[0], &switch_ids[0],
+                node_remap)
+
+    def set_metadata(self, unsigned int index, metadata):
+        """ Write edge metadata, NodeMetadata or (name, value) tuples. """
+        assert index < self.num_edges
+        self.c_edges.init_metas(index, len(metadata))
+        for meta_index, meta in enumerate(metadata):
+            if isinstance(meta, tuple) and len(meta) == 2:
+                name, value = meta
+            else:
+                name, value = meta.name, meta.value
+            self.c_edges.set_meta(index, meta_index, name, value)
+
+def _zeros(typecode, size_t size):
+    return array(typecode, bytes(array(typecode).itemsize * size))
+
+cdef class _RrGraphDecoder:
+    """ Decodes an RrGraph message to NodeStore and EdgeStore columns.
+
+    buffer is the serialized message (bytes, mmap or any other buffer), in
+    the packed encoding if packed.  The message is read natively with the
+    compiled-in schema, independently of any pycapnp reader of the same
+    buffer.  The decoder holds an export of buffer until it is deleted.
+
+    """
+    cdef RrGraphDecoder *c_decoder
+    cdef const unsigned char[::1] buffer
+
+    def __cinit__(self, const unsigned char[::1] buffer, bint packed=False):
+        assert buffer.shape[0] > 0
+        self.buffer = buffer
+        self.c_decoder = new RrGraphDecoder(
+            &buffer[0], buffer.shape[0], packed)
+
+    def __dealloc__(self):
+        del self.c_decoder
+
+    def num_nodes(self):
+        return self.c_decoder.num_nodes()
+
+    def num_edges(self):
+        return self.c_decoder.num_edges()
+
+    def decode_nodes(
+            self,
+            const unsigned char[::1] keep_types,
+            const int[::1] type_codes,
+            const int[::1] direction_codes,
+            const int[::1] side_codes,
+            bint rebase_nodes):
+        """ Decode rrNodes.nodes into NodeStore columns.
+
+        keep_types, type_codes, direction_codes and side_codes are indexed
+        by capnp enumerant ordinal.  Nodes whose keep_types entry is 0 are
+        skipped, the *_codes tables give the graph2 enum value (or -1 for
+        None).
+
+        Returns a dict of column name to array.array.
+
+        """
+        cdef size_t num_nodes = self.c_decoder.num_nodes()
+        cdef size_t count
+
+        columns = dict(
+            id=_zeros('i', num_nodes),
+            type=_zeros('b', num_nodes),
+            direction=_zeros('b', num_nodes),
+            capacity=_zeros('i', num_nodes),
+            x_low=_zeros('h', num_nodes),
+            y_low=_zeros('h', num_nodes),
+            x_high=_zeros('h', num_nodes),
+            y_high=_zeros('h', num_nodes),
+            side=_zeros('b', num_nodes),
+            ptc=_zeros('i', num_nodes),
+            r=_zeros('d', num_nodes),
+            c=_zeros('d', num_nodes),
+            int_timing=_zeros('b', num_nodes),
+            segment_id=_zeros('i', num_nodes),
+        )
+        if num_nodes == 0:
+            return columns
+
+        count = _decode_nodes(
+            self.c_decoder, keep_types, type_codes, direction_codes,
+            side_codes, rebase_nodes, columns['id'], columns['type'],
+            columns['direction'], columns['capacity'], columns['x_low'],
+            columns['y_low'], columns['x_high'], columns['y_high'],
+            columns['side'], columns['ptc'], columns['r'], columns['c'],
+            columns['segment_id'])
+
+        for column in columns.values():
+            del column[count:]
+
+        return columns
+
+    def decode_edges(
+            self, size_t first=0, last=None,
+            const unsigned char[::1] src_filter=None,
+            const unsigned char[::1] sink_filter=None):
+        """ Decode rrEdges.edges into EdgeStore columns.
+
+        Only edges [first, last) are decoded, by default all edges.  If
+        src_filter (sink_filter) is given, it is a table of bytes indexed by
+        node id, and only edges whose src (sink) node has a non-zero entry
+        are decoded.
+
+        Returns a dict of column name to array.array, an array('I') of the
+        index of each decoded edge (None if no filter is given, then decoded
+        edges are edges first to last), and the list of column positions of
+        edges that have metadata, which is not decoded.
+
+        """
+        cdef size_t stop
+        cdef size_t count = 0
+        cdef vector[unsigned int] with_metadata
+        cdef const unsigned char *src_filter_ptr = NULL
+        cdef const unsigned char *sink_filter_ptr = NULL
+        cdef size_t src_filter_size = 0
+        cdef size_t sink_filter_size = 0
+        cdef unsigned int[::1] src_nodes
+        cdef unsigned int[::1] sink_nodes
+        cdef unsigned int[::1] switch_ids
+        cdef unsigned int[::1] edge_id_view
+        cdef unsigned int *edge_ids_ptr = NULL
+
+        stop = self.c_decoder.num_edges() if last is None else last
+        assert first <= stop <= self.c_decoder.num_edges(), (first, stop)
+
+        columns = dict(
+            src_node=_zeros('I', stop - first),
+            sink_node=_zeros('I', stop - first),
+            switch_id=_zeros('I', stop - first),
+        )
+
+        edge_ids = None
+        if src_filter is not None or sink_filter is not None:
+            edge_ids = _zeros('I', stop - first)
+
+        if stop > first:
+            src_nodes = columns['src_node']
+            sink_nodes = columns['sink_node']
+            switch_ids = columns['switch_id']
+
+            if src_filter is not None and src_filter.shape[0] > 0:
+                src_filter_ptr = &src_filter[0]
+                src_filter_size = src_filter.shape[0]
+            elif src_filter is not None:
+                # Empty filter, nothing matches.
+                stop = first
+
+            if sink_filter is not None and sink_filter.shape[0] > 0:
+                sink_filter_ptr = &sink_filter[0]
+                sink_filter_size = sink_filter.shape[0]
+            elif sink_filter is not None:
+                stop = first
+
+            if edge_ids is not None:
+                edge_id_view = edge_ids
+                edge_ids_ptr = &edge_id_view[0]
+
+            with nogil:
+                count = self.c_decoder.decode_edges(
+                    first, stop, src_filter_ptr, src_filter_size,
+                    sink_filter_ptr, sink_filter_size, &src_nodes[0],
+                    &sink_nodes[0], &switch_ids[0], edge_ids_ptr,
+                    &with_metadata)
+
+        for column in columns.values():
+            del column[count:]
+
+        if edge_ids is not None:
+            del edge_ids[count:]
+
+        return columns, edge_ids, list(with_metadata)
+
+cdef size_t _decode_nodes(
+        RrGraphDecoder *decoder,
+        const unsigned char[::1] keep_types,
+        const int[::1] type_codes,
+        const int[::1] direction_codes,
+        const int[::1] side_codes,
+        bint rebase_nodes,
+        int[::1] ids,
+        signed char[::1] types,
+        signed char[::1] directions,
+        int[::1] capacities,
+        short[::1] x_lows,
+        short[::1] y_lows,
+        short[::1] x_highs,
+        short[::1] y_highs,
+        signed char[::1] sides,
+        int[::1] ptcs,
+        double[::1] rs,
+        double[::1] cs,
+        int[::1] segment_ids) except? 0:
+    cdef size_t count
+
+    with nogil:
+        count = decoder.decode_nodes(
+            &keep_types[0], &type_codes[0], &direction_codes[0],
+            &side_codes[0], rebase_nodes, &ids[0], &types[0],
+            &directions[0], &capacities[0], &x_lows[0], &y_lows[0],
+            &x_highs[0], &y_highs[0], &sides[0], &ptcs[0], &rs[0], &cs[0],
+            &segment_ids[0])
+
+    return count
@@ -1,4 +1,5 @@
 """ Graph object that handles serialization and deserialization from XML. """
+import itertools
 from . import graph2
 from .graph2 import NodeDirection
 from . import tracks
@@ -212,14 +213,16 @@ def graph_from_xml(
 
         # Node - timing
         if path == "rr_graph/rr_nodes/node" and element.tag == "timing":
-            node_timing = graph2.NodeTiming(
+            node_timing = graph2.intern_node_timing(
                 r=float(element.attrib['R']),
                 c=float(element.attrib['C']),
             )
 
         # Node - segment
         if path == "rr_graph/rr_nodes/node" and element.tag == "segment":
-            node_segment = int(element.attrib['segment_id'])
+            node_segment = graph2.intern_node_segment(
+                int(element.attrib['segment_id'])
+            )
 
         # Node
         if path == "rr_graph/rr_nodes" and element.tag == "node":
@@ -279,6 +282,7 @@ def graph_from_xml(
 
 
 class Graph(object):
+    @graph2.memory_phase('construction')
     def __init__(
             self,
             input_file_name,
@@ -287,6 +291,7 @@ class Graph(object):
             build_pin_edges=True,
             rebase_nodes=True,
             filter_nodes=True,
+            virtual_pin_edges=False,
     ):
         if progressbar is None:
             progressbar = lambda x: x  # noqa: E731
@@ -299,6 +304,7 @@ class Graph(object):
             input_file_name, progressbar, filter_nodes=filter_nodes
         )
         graph_input['build_pin_edges'] = build_pin_edges
+        graph_input['virtual_pin_edges'] = virtual_pin_edges
 
         self.root_attrib = graph_input["root_attrib"]
         del graph_input["root_attrib"]
@@ -648,6 +654,7 @@ class Graph(object):
 
         self._end_xml_tag()
 
+    @graph2.memory_phase('serialize')
     def serialize_to_xml(
             self,
             channels_obj,
@@ -658,9 +665,20 @@ class Graph(object):
     ):
         """
         Writes the routing graph to the XML file.
+
+        If the graph was built with virtual_pin_edges, the pin edges are
+        written before edges_obj.
+
+        node_remap is either a callable or an array (or any sequence) of new
+        node ids indexed by old node id, see Graph.compute_node_remap.
         """
 
         self.graph.check_ptc()
+        node_remap = graph2.node_remap_function(node_remap)
+
+        edges_obj = itertools.chain(
+            self.graph.iter_virtual_pin_edges(), edges_obj
+        )
 
         # Open the file
         with open(self.output_file_name, "w") as xf:
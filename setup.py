@@ -4,6 +4,7 @@ from Cython.Build import cythonize
 
 extensions = [
     Extension("rr_graph.graph2_cpy", ["rr_graph/graph2_cpy.pyx"],
+        depends=["rr_graph/graph2_capnp.h"],
         include_dirs=[".",
             "third_party/pycapnp/",
             "/usr/local/google/home/keithrothman/cat_x/vtr-verilog-to-routing/build/libs/libvtrcapnproto/gen/",
@@ -1,11 +1,20 @@
+import gc
+import multiprocessing
+import os
+import tempfile
+import tracemalloc
 import unittest
 
+from array import array
 from copy import deepcopy
 
 from rr_graph.graph2 import SwitchTiming, SwitchSizing, Switch, SwitchType, \
     Graph, SegmentTiming, Segment, PinClass, Pin, PinType, \
     BlockType, GridLoc, NodeTiming, NodeSegment, Node, NodeType, \
-    NodeDirection, NodeLoc
+    NodeDirection, NodeLoc, NodeMetadata, CanonicalLoc, NodeStore, \
+    Edge, EdgeStore, EdgeIndex, MemoryPhaseTracker, intern_node_timing, \
+    intern_node_segment, hilbert_index, remap_node_ids, node_remap_table, \
+    clear_intern_caches, _balance_chunks
 from rr_graph.tracks import Track, Direction
 
 
@@ -151,6 +160,39 @@ class Graph2Tests(unittest.TestCase):
             deepcopy(self.nodes)
         )
 
+        self.assertEqual(
+            self.graph.loc_pin_map, {
+                (0, 0, 0): [(0, Direction.LEFT)],
+                (0, 0, 1): [(2, Direction.LEFT)],
+            }
+        )
+        self.assertEqual(
+            self.graph.loc_pin_class_map, {
+                (0, 0, 0): 1,
+                (0, 0, 1): 3
+            }
+        )
+        self.assertEqual(
+            [tuple(edge) for edge in self.graph.edges], [
+                (0, 1, 1, None),
+                (3, 2, 1, None),
+            ]
+        )
+
+        nodes = deepcopy(self.nodes)
+        nodes[3] = nodes[3]._replace(loc=nodes[1].loc)
+        with self.assertRaises(AssertionError):
+            Graph(
+                self.switches, self.segments, self.block_types, self.grid,
+                nodes
+            )
+
+        with self.assertRaises(AssertionError):
+            Graph(
+                self.switches, self.segments, self.block_types, self.grid,
+                deepcopy(self.nodes[1:])
+            )
+
     def test_add_track(self):
         trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
         segment_id = -1
@@ -164,6 +206,54 @@ class Graph2Tests(unittest.TestCase):
         self.assertEqual(node.direction, NodeDirection.BI_DIR)
         self.assertEqual(node.capacity, 1)
 
+    def test_add_track_interning(self):
+        trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
+        node_ids = [
+            self.graph.add_track(trk, 0, name='t') for _ in range(2)
+        ] + [
+            self.graph.add_track(
+                trk, 0, timing=NodeTiming(r=1, c=1), name='t'
+            )
+        ]
+
+        nodes = [self.graph.nodes[node_id] for node_id in node_ids]
+        for node in nodes[1:]:
+            self.assertIs(node.timing, nodes[0].timing)
+            self.assertIs(node.segment, nodes[0].segment)
+            self.assertEqual(node.metadata, nodes[0].metadata)
+
+        self.assertEqual(nodes[0].timing, NodeTiming(r=1, c=1))
+        self.assertEqual(nodes[0].segment, NodeSegment(segment_id=0))
+        self.assertEqual(
+            nodes[0].metadata, [
+                NodeMetadata(
+                    name='t', x_offset=0, y_offset=0, z_offset=0, value=''
+                ),
+            ]
+        )
+
+    def test_intern(self):
+        self.assertIs(intern_node_timing(2, 3), intern_node_timing(2, 3))
+        self.assertEqual(intern_node_timing(2, 3), NodeTiming(r=2, c=3))
+        self.assertIs(type(intern_node_timing(2.0, 3.0).r), float)
+        self.assertIs(type(intern_node_timing(2, 3).r), int)
+        self.assertIs(intern_node_segment(4), intern_node_segment(4))
+        self.assertEqual(intern_node_segment(4), NodeSegment(segment_id=4))
+
+    def test_intern_timing_stable(self):
+        trk = Track(direction='X', x_low=1, x_high=3, y_low=1, y_high=1)
+        track = self.graph.add_track(trk, segment_id=0)
+
+        # Node timing read from the store must not depend on which spelling
+        # of the same value was interned first.
+        reprs = set()
+        for first in ((1, 1), (1.0, 1.0)):
+            clear_intern_caches()
+            intern_node_timing(*first)
+            reprs.add(repr(self.graph.nodes[track].timing))
+
+        self.assertEqual(len(reprs), 1, reprs)
+
     def test_add_edge(self):
         trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
         segment_id = -1
@@ -183,6 +273,74 @@ class Graph2Tests(unittest.TestCase):
         self.assertEqual(self.graph.edges[idx].switch_id, 0)
         self.assertEqual(self.graph.edges[idx].metadata, None)
 
+    def test_sort_and_dedup_edges(self):
+        trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
+        for _ in range(3):
+            self.graph.add_track(trk, -1)
+
+        self.graph.add_edge(2, 1, 0)
+        self.graph.add_edge(0, 1, 0)
+        self.graph.add_edge(2, 1, 0)
+        self.assertEqual(self.graph.fanout(2), [0, 2])
+
+        self.assertEqual(self.graph.sort_and_dedup_edges(), 1)
+        self.assertEqual(
+            list(self.graph.edges), [Edge(0, 1, 0, None),
+                                     Edge(2, 1, 0, None)]
+        )
+        self.assertEqual(self.graph.fanout(2), [1])
+        self.assertEqual(self.graph.fanin(1), [0, 1])
+
+    def test_add_edges(self):
+        trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
+        for _ in range(3):
+            self.graph.add_track(trk, -1)
+
+        idxs = self.graph.add_edges(
+            array('l', [0, 1]), memoryview(array('I', [1, 2])), [0, 0],
+            metadata=[None, [('a', 'b')]]
+        )
+        self.assertEqual(idxs, range(0, 2))
+        self.assertEqual(
+            list(self.graph.edges), [
+                Edge(src_node=0, sink_node=1, switch_id=0, metadata=None),
+                Edge(
+                    src_node=1,
+                    sink_node=2,
+                    switch_id=0,
+                    metadata=[('a', 'b')]
+                ),
+            ]
+        )
+
+        with self.assertRaises(AssertionError):
+            self.graph.add_edges([0], [3], [0])
+
+        with self.assertRaises(AssertionError):
+            self.graph.add_edges([0], [1], [1])
+
+        with self.assertRaises(OverflowError):
+            self.graph.add_edges([-1], [1], [0])
+
+        self.assertEqual(len(self.graph.edges), 2)
+
+    def test_fanout_fanin(self):
+        trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
+        for _ in range(3):
+            self.graph.add_track(trk, -1)
+
+        self.graph.add_edge(0, 1, 0)
+        self.graph.add_edge(0, 2, 0)
+        self.graph.add_edge(1, 2, 0)
+
+        self.assertEqual(self.graph.fanout(0), [0, 1])
+        self.assertEqual(self.graph.fanin(2), [1, 2])
+        self.assertEqual(self.graph.fanin(0), [])
+
+        idx = self.graph.add_edge(2, 0, 0)
+        self.assertEqual(self.graph.fanout(2), [idx])
+        self.assertEqual(self.graph.fanin(0), [idx])
+
     def test_add_switch(self):
         idx = self.graph.add_switch(
             Switch(
@@ -218,6 +376,22 @@ class Graph2Tests(unittest.TestCase):
         self.graph.set_track_ptc(node_id, 0)
         self.graph.check_ptc()
 
+    def test_assign_ptcs(self):
+        trk = Track(direction='Y', x_low=2, x_high=2, y_low=1, y_high=3)
+        tracks = [self.graph.add_track(trk, -1) for _ in range(3)]
+
+        self.graph.assign_ptcs(tracks[:2], [4, 5])
+        self.assertEqual(self.graph.nodes[tracks[1]].loc.ptc, 5)
+
+        with self.assertRaises(AssertionError):
+            self.graph.check_ptc()
+
+        with self.assertRaises(AssertionError):
+            self.graph.assign_ptcs(tracks, [0, 1, 2])
+
+        self.graph.assign_ptcs(tracks[2:], [0])
+        self.graph.check_ptc()
+
     def test_block_type_at_loc_asserts(self):
         loc = (0, 0)
         with self.assertRaises(KeyError):
@@ -379,6 +553,40 @@ class Graph2MediumTests(unittest.TestCase):
         name = self.graph.block_type_at_loc(loc)
         self.assertEqual(name, 'b0')
 
+    def test_virtual_pin_edges(self):
+        graph = Graph(
+            self.switches,
+            self.segments,
+            self.block_types,
+            self.grid,
+            deepcopy(self.nodes),
+            virtual_pin_edges=True,
+        )
+
+        self.assertEqual(len(graph.edges), 0)
+        self.assertEqual(graph.num_virtual_pin_edges, 2)
+        self.assertEqual(
+            list(graph.iter_virtual_pin_edges()), list(self.graph.edges)
+        )
+        self.assertEqual(list(self.graph.iter_virtual_pin_edges()), [])
+
+        self.assertEqual(
+            list(graph.virtual_pin_edge_store()),
+            list(graph.iter_virtual_pin_edges())
+        )
+        self.assertEqual(len(self.graph.virtual_pin_edge_store()), 0)
+
+        # Virtual pin edges are not stored, so edge queries don't see them.
+        for edge in graph.iter_virtual_pin_edges():
+            self.assertEqual(len(self.graph.fanout(edge.src_node)), 1)
+            self.assertEqual(len(self.graph.fanin(edge.sink_node)), 1)
+            self.assertEqual(graph.fanout(edge.src_node), [])
+            self.assertEqual(graph.fanin(edge.sink_node), [])
+
+        self.assertEqual(graph.sort_and_dedup_edges(), 0)
+        self.assertEqual(len(graph.edges), 0)
+        self.assertEqual(graph.num_virtual_pin_edges, 2)
+
     def test_get_nodes_for_pin(self):
         nodes = self.graph.get_nodes_for_pin((0, 0), 'p1')
         self.assertEqual(nodes, [
@@ -391,5 +599,559 @@ class Graph2MediumTests(unittest.TestCase):
         with self.assertRaises(AssertionError):
             self.graph.get_nodes_for_pin((0, 0), 'p3')
 
+        with self.assertRaises(KeyError):
+            self.graph.get_nodes_for_pin((1, 0), 'p1')
+
+    def test_get_nodes_for_pins(self):
+        node_ids, offsets = self.graph.get_nodes_for_pins(
+            [(0, 0), (0, 0), (0, 0)], ['p1', 'p2', 'p1']
+        )
+        self.assertEqual(list(node_ids), [0, 2, 0])
+        self.assertEqual(list(offsets), [0, 1, 2, 3])
+
+        node_ids, offsets = self.graph.get_nodes_for_pins([], [])
+        self.assertEqual(list(offsets), [0])
+
+        with self.assertRaises(KeyError):
+            self.graph.get_nodes_for_pins([(0, 0)], ['d1'])
+
+        with self.assertRaises(AssertionError):
+            self.graph.get_nodes_for_pins([(0, 0)], ['p3'])
+
+        with self.assertRaises(KeyError):
+            self.graph.get_nodes_for_pins([(0, 1)], ['p1'])
+
+    def _add_tracks(self, graph):
+        for y, (x_low, x_high) in enumerate([(1, 3), (2, 2), (4, 5), (1, 4)]):
+            graph.add_track(
+                Track(
+                    direction='X',
+                    x_low=x_low,
+                    x_high=x_high,
+                    y_low=y % 2,
+                    y_high=y % 2
+                ), 0
+            )
+            graph.add_track(
+                Track(
+                    direction='Y',
+                    x_low=y % 2,
+                    x_high=y % 2,
+                    y_low=x_low,
+                    y_high=x_high
+                ), 0
+            )
+
     def test_create_channels(self):
-        pass
+        self._add_tracks(self.graph)
+        channels = self.graph.create_channels(pad_segment=0)
+        self.graph.check_ptc()
+
+        self.assertEqual(channels.chan_width_max, 2)
+        self.assertEqual([chan.info for chan in channels.x_list], [1, 2])
+        self.assertEqual([chan.info for chan in channels.y_list], [1, 2])
+
+        padding = [
+            node for node in self.graph.nodes[len(self.nodes):]
+            if node.capacity == 0
+        ]
+        self.assertEqual(len(padding), 6)
+        self.assertEqual(
+            padding[0].loc,
+            NodeLoc(x_low=5, x_high=5, y_low=1, y_high=1, side=None, ptc=0)
+        )
+        self.assertEqual(padding[-1].type, NodeType.CHANY)
+
+    def test_compute_node_remap(self):
+        self._add_tracks(self.graph)
+        nodes = list(self.graph.nodes)
+
+        for order in ('hilbert', 'type_loc'):
+            remap = self.graph.compute_node_remap(order)
+            self.assertEqual(remap.typecode, 'I')
+            self.assertEqual(sorted(remap), list(range(len(nodes))))
+
+            new_nodes = [None] * len(nodes)
+            for node in nodes:
+                new_nodes[remap[node.id]] = node
+
+            if order == 'hilbert':
+                keys = [
+                    hilbert_index(node.loc.x_low, node.loc.y_low, 3)
+                    for node in new_nodes
+                ]
+            else:
+                keys = [
+                    (node.type.value, node.loc.x_low, node.loc.y_low)
+                    for node in new_nodes
+                ]
+            self.assertEqual(keys, sorted(keys))
+
+        with self.assertRaises(AssertionError):
+            self.graph.compute_node_remap('random')
+
+    def test_hilbert_index(self):
+        curve = sorted(
+            (hilbert_index(x, y, 2), (x, y)) for x in range(4)
+            for y in range(4)
+        )
+        self.assertEqual([d for d, _ in curve], list(range(16)))
+        for (_, (x0, y0)), (_, (x1, y1)) in zip(curve, curve[1:]):
+            self.assertEqual(abs(x1 - x0) + abs(y1 - y0), 1)
+
+    def test_remap_node_ids(self):
+        remap = array('I', [2, 0, 1])
+        self.assertEqual(
+            list(remap_node_ids(remap, [0, 1, 2, 0])), [2, 0, 1, 2]
+        )
+        self.assertEqual(
+            list(remap_node_ids([2, 0, 1], array('I', [1]))), [0]
+        )
+        self.assertEqual(
+            list(remap_node_ids(lambda x: x + 1, range(2))), [1, 2]
+        )
+
+    def test_snapshot(self):
+        self._add_tracks(self.graph)
+        self.graph.add_edge(0, 1, 0, name='a', value='b')
+        self.graph.nodes.metadata[1] = [
+            NodeMetadata(
+                name='n', x_offset=0, y_offset=0, z_offset=0, value=''
+            )
+        ]
+        fanout = self.graph.fanout(0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'graph.snapshot')
+            self.graph.save_snapshot(path)
+            graph = Graph.load_snapshot(path)
+
+        self.assertEqual(list(graph.nodes), list(self.graph.nodes))
+        self.assertEqual(list(graph.edges), list(self.graph.edges))
+        for name in ('tracks', 'loc_map', 'loc_pin_map', 'loc_pin_class_map',
+                     'pin_name_map', 'switch_name_map', 'block_types', 'grid'):
+            self.assertEqual(
+                getattr(graph, name), getattr(self.graph, name), name
+            )
+        self.assertEqual(
+            graph.get_nodes_for_pin((0, 0), 'p1'),
+            self.graph.get_nodes_for_pin((0, 0), 'p1')
+        )
+        self.assertEqual(graph.fanout(0), fanout)
+
+        # The loaded graph can still be extended.
+        self.assertEqual(
+            graph.create_channels(pad_segment=0),
+            self.graph.create_channels(pad_segment=0)
+        )
+        self.assertEqual(list(graph.nodes), list(self.graph.nodes))
+
+    def test_snapshot_version(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'graph.snapshot')
+            self.graph.save_snapshot(path)
+
+            with open(path, 'r+b') as f:
+                f.seek(8)
+                f.write(b'\xff')
+
+            with self.assertRaises(AssertionError):
+                Graph.load_snapshot(path)
+
+    def test_node_remap_table(self):
+        table = node_remap_table(lambda x: 2 - x, 3)
+        self.assertEqual(table, array('I', [2, 1, 0]))
+        self.assertEqual(node_remap_table(None, 2), array('I', [0, 1]))
+
+        remap = array('I', [1, 0])
+        self.assertIs(node_remap_table(remap, 2), remap)
+        self.assertEqual(node_remap_table([1, 0], 2), remap)
+
+        with self.assertRaises(AssertionError):
+            node_remap_table([1, 0], 3)
+
+    def test_memory_report(self):
+        self._add_tracks(self.graph)
+        channels = self.graph.create_channels(pad_segment=0)
+
+        report = self.graph.memory_report(channels=channels)
+        for name in ('nodes', 'edges', 'loc_pin_map', 'pin_name_map',
+                     'tracks', 'channels'):
+            self.assertGreater(report[name], 0, name)
+        self.assertEqual(
+            report['total'],
+            sum(size for name, size in report.items() if name != 'total')
+        )
+
+        self.assertNotIn('channels', self.graph.memory_report())
+
+    def test_memory_phases(self):
+        self.assertFalse(tracemalloc.is_tracing())
+        with MemoryPhaseTracker() as tracker:
+            self.assertTrue(tracemalloc.is_tracing())
+            graph = Graph(
+                self.switches, self.segments, self.block_types, self.grid,
+                deepcopy(self.nodes)
+            )
+            self._add_tracks(graph)
+            graph.create_channels(pad_segment=0)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        self.assertEqual(
+            sorted(tracker.peaks), ['construction', 'create_channels']
+        )
+        for peak in tracker.peaks.values():
+            self.assertGreater(peak, 0)
+
+        # Phases are not recorded without an active tracker.
+        peaks = dict(tracker.peaks)
+        self._add_tracks(self.graph)
+        self.graph.create_channels(pad_segment=0)
+        self.assertEqual(tracker.peaks, peaks)
+
+    def test_create_channels_pool(self):
+        self._add_tracks(self.graph)
+        channels = self.graph.create_channels(pad_segment=0)
+
+        graph = Graph(
+            self.switches, self.segments, self.block_types, self.grid,
+            deepcopy(self.nodes)
+        )
+        self._add_tracks(graph)
+        with multiprocessing.Pool(2) as pool:
+            pool_channels = graph.create_channels(
+                pad_segment=0, pool=pool, num_chunks=3
+            )
+
+        self.assertEqual(pool_channels, channels)
+        self.assertEqual(list(graph.nodes), list(self.graph.nodes))
+
+
+class NodeStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [
+            Node(
+                id=1,
+                type=NodeType.CHANX,
+                direction=NodeDirection.INC_DIR,
+                capacity=1,
+                loc=NodeLoc(
+                    x_low=1, x_high=4, y_low=2, y_high=2, side=None, ptc=None
+                ),
+                timing=NodeTiming(r=1, c=1),
+                metadata=[
+                    NodeMetadata(
+                        name='a', x_offset=0, y_offset=0, z_offset=0, value=''
+                    )
+                ],
+                segment=NodeSegment(segment_id=-1),
+                canonical_loc=CanonicalLoc(x=1, y=2),
+                connection_box=None,
+            ),
+            Node(
+                id=0,
+                type=NodeType.IPIN,
+                direction=None,
+                capacity=1,
+                loc=NodeLoc(
+                    x_low=0,
+                    x_high=0,
+                    y_low=0,
+                    y_high=0,
+                    side=Direction.LEFT,
+                    ptc=3
+                ),
+                timing=None,
+                metadata=None,
+                segment=None,
+                canonical_loc=None,
+                connection_box=None,
+            ),
+        ]
+
+    def test_roundtrip(self):
+        store = NodeStore(self.nodes)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store), self.nodes)
+        self.assertEqual(store[-1], self.nodes[1])
+        self.assertEqual(store[0:1], self.nodes[0:1])
+
+    def test_append(self):
+        store = NodeStore()
+        for node in self.nodes:
+            store.append(node)
+        self.assertEqual(list(store), self.nodes)
+
+        with self.assertRaises(OverflowError):
+            store.append(
+                self.nodes[1]._replace(
+                    loc=self.nodes[1].loc._replace(x_low=1 << 20)
+                )
+            )
+        self.assertEqual(list(store), self.nodes)
+
+    def test_sort(self):
+        store = NodeStore(self.nodes)
+        store.sort()
+        self.assertEqual(list(store), [self.nodes[1], self.nodes[0]])
+        self.assertEqual(store.metadata, {1: self.nodes[0].metadata})
+        self.assertEqual(store.canonical_loc, {1: CanonicalLoc(x=1, y=2)})
+
+    def test_from_columns(self):
+        store = NodeStore(self.nodes)
+        columns = {name: getattr(store, name) for name in NodeStore.COLUMNS}
+
+        adopted = NodeStore.from_columns(
+            metadata=store.metadata,
+            canonical_loc=store.canonical_loc,
+            connection_box=store.connection_box,
+            **columns
+        )
+        self.assertIs(adopted.x_low, store.x_low)
+        self.assertEqual(list(adopted), list(store))
+
+        with self.assertRaises(AssertionError):
+            NodeStore.from_columns(id=array('I', [0]))
+        with self.assertRaises(AssertionError):
+            NodeStore.from_columns(id=array('i', [0]))
+
+        edges = EdgeStore.from_columns(
+            src_node=array('I', [0]),
+            sink_node=array('I', [1]),
+            switch_id=array('I', [2])
+        )
+        self.assertEqual(list(edges), [Edge(0, 1, 2, None)])
+
+    def test_add_nodes(self):
+        store = NodeStore(self.nodes[1:])
+        node_ids = store.add_nodes(
+            x_low=[1, 5],
+            y_low=[2, 2],
+            x_high=[4, 6],
+            y_high=[2, 2],
+            ptc=array('i', [0, 1]),
+            type=NodeType.CHANX,
+            direction=NodeDirection.BI_DIR,
+            capacity=0,
+            side=None,
+            timing=NodeTiming(r=1, c=1),
+            segment=NodeSegment(segment_id=-1),
+        )
+
+        self.assertEqual(node_ids, range(1, 3))
+        self.assertEqual(
+            store[2],
+            self.nodes[0]._replace(
+                id=2,
+                direction=NodeDirection.BI_DIR,
+                capacity=0,
+                loc=NodeLoc(
+                    x_low=5, x_high=6, y_low=2, y_high=2, side=None, ptc=1
+                ),
+                metadata=None,
+                canonical_loc=None,
+            )
+        )
+
+    def test_setitem(self):
+        store = NodeStore(self.nodes)
+        node = self.nodes[0]._replace(metadata=None, canonical_loc=None)
+        store[0] = node
+        self.assertEqual(store[0], node)
+        self.assertEqual(store.metadata, {})
+
+    def test_invalid_type(self):
+        store = NodeStore(self.nodes)
+        store.type[0] = -1
+        node = self.nodes[0]._replace(type=None)
+        self.assertEqual(store[0], node)
+        self.assertEqual(list(store)[0], node)
+
+        store[1] = self.nodes[1]._replace(type=None)
+        self.assertEqual(store.type[1], -1)
+        self.assertEqual(list(NodeStore(store)), list(store))
+
+
+class EdgeStoreTests(unittest.TestCase):
+    def test_roundtrip(self):
+        edges = [
+            Edge(src_node=0, sink_node=1, switch_id=2, metadata=None),
+            Edge(
+                src_node=3,
+                sink_node=4,
+                switch_id=0,
+                metadata=[('name', 'value')]
+            ),
+        ]
+        store = EdgeStore(edges)
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store), edges)
+        self.assertEqual(store[-1], edges[1])
+        self.assertEqual(store.metadata, {1: [('name', 'value')]})
+
+        for src_node, sink_node, switch_id, metadata in store:
+            self.assertIn(switch_id, (0, 2))
+
+    def test_add_edge(self):
+        store = EdgeStore()
+        self.assertEqual(store.add_edge(1, 2, 3), 0)
+        self.assertEqual(store.add_edge(2, 3, 4, [('a', 'b')]), 1)
+        self.assertEqual(list(store.src_node), [1, 2])
+
+        with self.assertRaises(OverflowError):
+            store.add_edge(1, -2, 3)
+        self.assertEqual(len(store.src_node), 2)
+
+    def test_add_edges(self):
+        store = EdgeStore()
+        self.assertEqual(
+            store.add_edges(
+                array('I', [1, 2]), array('I', [2, 3]), array('I', [0, 1]),
+                [None, (('a', 'b'), )]
+            ), range(0, 2)
+        )
+        self.assertEqual(list(store.sink_node), [2, 3])
+        self.assertEqual(store.metadata, {1: (('a', 'b'), )})
+
+        with self.assertRaises(AssertionError):
+            store.add_edges(
+                array('I', [3, 4]), array('I', [4, 5]), array('I', [0, 0]),
+                [None]
+            )
+        self.assertEqual(len(store), 2)
+
+    def _dedup_store(self):
+        store = EdgeStore()
+        store.add_edge(2, 0, 0)
+        store.add_edge(1, 3, 0, [('a', 'b')])
+        store.add_edge(2, 0, 0, [('c', 'd')])
+        store.add_edge(1, 2, 1)
+        store.add_edge(1, 3, 0)
+        store.add_edge(0, 3, 0)
+        store.add_edge(1, 3, 0, [('a', 'b')])
+        store.add_edge(1, 2, 0)
+        return store
+
+    def test_sort_and_dedup(self):
+        store = self._dedup_store()
+        self.assertEqual(store.sort_and_dedup(), 3)
+        self.assertEqual(
+            list(store), [
+                Edge(0, 3, 0, None),
+                Edge(1, 2, 0, None),
+                Edge(1, 2, 1, None),
+                Edge(1, 3, 0, [('a', 'b')]),
+                Edge(2, 0, 0, None),
+            ]
+        )
+
+        store = self._dedup_store()
+        self.assertEqual(store.sort_and_dedup(order='sink'), 3)
+        self.assertEqual(
+            [(edge.src_node, edge.sink_node) for edge in store],
+            [(2, 0), (1, 2), (1, 2), (0, 3), (1, 3)]
+        )
+
+    def test_sort_and_dedup_metadata(self):
+        store = self._dedup_store()
+        self.assertEqual(store.sort_and_dedup(keep_first_metadata=False), 1)
+        self.assertEqual(
+            list(store), [
+                Edge(0, 3, 0, None),
+                Edge(1, 2, 0, None),
+                Edge(1, 2, 1, None),
+                Edge(1, 3, 0, [('a', 'b')]),
+                Edge(1, 3, 0, None),
+                Edge(2, 0, 0, None),
+                Edge(2, 0, 0, [('c', 'd')]),
+            ]
+        )
+
+    def test_sort_and_dedup_external(self):
+        for keep_first_metadata in (True, False):
+            for order in ('src', 'sink'):
+                expected = self._dedup_store()
+                expected.sort_and_dedup(order, keep_first_metadata)
+
+                for max_edges_in_memory in (1, 3, 100):
+                    store = self._dedup_store()
+                    with tempfile.TemporaryDirectory() as scratch_dir:
+                        store.sort_and_dedup(
+                            order,
+                            keep_first_metadata,
+                            max_edges_in_memory=max_edges_in_memory,
+                            scratch_dir=scratch_dir
+                        )
+                        self.assertEqual(os.listdir(scratch_dir), [])
+
+                    self.assertEqual(list(store), list(expected))
+
+    def test_sort_and_dedup_external_memory(self):
+        num_edges = 50000
+        max_edges_in_memory = num_edges // 20
+
+        def unique_edges():
+            store = EdgeStore()
+            store.add_edges(
+                array('I', (idx * 7919 % num_edges
+                            for idx in range(num_edges))),
+                array('I', (idx % 977 for idx in range(num_edges))),
+                array('I', (idx % 3 for idx in range(num_edges))),
+            )
+            return store
+
+        expected = unique_edges()
+        expected.sort_and_dedup()
+
+        # The store is created while tracing, so releasing its columns is
+        # traced too.
+        tracemalloc.start()
+        try:
+            store = unique_edges()
+            gc.collect()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            store.sort_and_dedup(max_edges_in_memory=max_edges_in_memory)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # The old columns (12 bytes per edge) are released before the merge
+        # builds the new ones, so the peak is the sort keys of one run and
+        # the merge buffers, well below a second copy of the columns.
+        self.assertLess(peak - before, 12 * num_edges // 2)
+        self.assertEqual(list(store), list(expected))
+
+
+class EdgeIndexTests(unittest.TestCase):
+    def test_edges(self):
+        keys = array('I', [2, 0, 2, 1, 2])
+        index = EdgeIndex(keys, num_nodes=4)
+
+        self.assertEqual(index.edges(0), [1])
+        self.assertEqual(index.edges(1), [3])
+        self.assertEqual(index.edges(2), [0, 2, 4])
+        self.assertEqual(index.edges(3), [])
+        self.assertEqual(index.edges(10), [])
+
+    def test_update(self):
+        keys = array('I', [2, 0])
+        index = EdgeIndex(keys, num_nodes=3)
+
+        keys.append(0)
+        self.assertEqual(index.edges(0), [1, 2])
+        self.assertEqual(index.overflow, {0: [2]})
+
+        keys.extend([5, 5, 5])
+        self.assertEqual(index.edges(5), [3, 4, 5])
+        self.assertEqual(index.overflow, {})
+        self.assertEqual(index.edges(0), [1, 2])
+
+
+class BalanceChunksTests(unittest.TestCase):
+    def test_balance_chunks(self):
+        self.assertEqual(
+            _balance_chunks([5, 1, 4, 2, 3], 2), [[0, 1, 3], [2, 4]]
+        )
+        self.assertEqual(_balance_chunks([1, 1], 4), [[0], [1]])
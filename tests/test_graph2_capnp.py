@@ -1,5 +1,32 @@
+import mmap
+import os
+import struct
+import tempfile
 import unittest
-from rr_graph.graph2_capnp import Graph
+from array import array
+from types import SimpleNamespace
+from unittest import mock
+
+import capnp
+
+from rr_graph import graph2
+from rr_graph import graph2_capnp
+from rr_graph.graph2_capnp import (
+    CAPNP_ENUM_CACHE, NATIVE_NODE_INSERTER, Graph, CapnpEdgeView,
+    CapnpReader, graph_from_capnp, load_capnp_schema, read_metadata,
+    read_node, to_capnp_enum, write_capnp_message
+)
+from rr_graph.tracks import Direction
+
+# Path to rr_graph_uxsdcxx.capnp, from VTR libs/libvtrcapnproto.
+RR_GRAPH_SCHEMA = os.environ.get('RR_GRAPH_SCHEMA')
+
+# Schema of the messages used to test reading and writing capnp files.
+MESSAGE_SCHEMA = (
+    '@0xb4e2f7c1a9d3e5f7;\n'
+    'struct A { x @0 :UInt32; l @1 :List(UInt32); }\n'
+)
+
 
 class Graph2CapnpTests(unittest.TestCase):
     def setUp(self):
@@ -7,3 +34,610 @@ class Graph2CapnpTests(unittest.TestCase):
 
     def test_import(self):
         _ = Graph
+
+    def test_load_capnp_schema(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema_fname = os.path.join(tmp_dir, 'test.capnp')
+            with open(schema_fname, 'w') as f:
+                f.write('@0xd0a8a3b0c6d2f1e5;\nstruct A { x @0 :UInt32; }\n')
+
+            schema = load_capnp_schema(schema_fname)
+            self.assertIs(load_capnp_schema(schema_fname), schema)
+            self.assertEqual(list(schema.A.schema.fieldnames), ['x'])
+
+            with open(schema_fname, 'w') as f:
+                f.write(
+                    '@0xd0a8a3b0c6d2f1e5;\n'
+                    'struct A { x @0 :UInt32; y @1 :UInt32; }\n'
+                )
+            stat = os.stat(schema_fname)
+            os.utime(
+                schema_fname,
+                ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000)
+            )
+
+            new_schema = load_capnp_schema(schema_fname)
+            self.assertIsNot(new_schema, schema)
+            self.assertEqual(
+                list(new_schema.A.schema.fieldnames), ['x', 'y']
+            )
+
+    def test_capnp_enum_cache_reload(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema_fname = os.path.join(tmp_dir, 'enum.capnp')
+            with open(schema_fname, 'w') as f:
+                f.write('@0xc1a2b3c4d5e6f708;\nenum E { chanx @0; }\n')
+
+            schema = load_capnp_schema(schema_fname)
+            self.assertEqual(
+                to_capnp_enum(schema.E, graph2.NodeType.CHANX), 0
+            )
+
+            with open(schema_fname, 'w') as f:
+                f.write(
+                    '@0xc1a2b3c4d5e6f708;\nenum E { chany @0; chanx @1; }\n'
+                )
+            stat = os.stat(schema_fname)
+            os.utime(
+                schema_fname,
+                ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000)
+            )
+
+            new_schema = load_capnp_schema(schema_fname)
+            self.assertNotIn(
+                (schema.E, graph2.NodeType.CHANX), CAPNP_ENUM_CACHE
+            )
+            self.assertEqual(
+                to_capnp_enum(new_schema.E, graph2.NodeType.CHANX), 1
+            )
+
+    def load_message_schema(self, tmp_dir):
+        schema_fname = os.path.join(tmp_dir, 'message.capnp')
+        with open(schema_fname, 'w') as f:
+            f.write(MESSAGE_SCHEMA)
+
+        return load_capnp_schema(schema_fname)
+
+    def write_message(self, schema, output, packed=False):
+        message = schema.A.new_message(x=5)
+        values = message.init('l', 100)
+        for idx in range(len(values)):
+            values[idx] = idx * 3
+
+        write_capnp_message(message, output, packed=packed)
+
+    def check_message(self, root):
+        self.assertEqual(root.x, 5)
+        self.assertEqual(list(root.l), [idx * 3 for idx in range(100)])
+
+    def test_capnp_reader(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            self.write_message(schema, message_fname)
+
+            with CapnpReader(schema.A, message_fname) as reader:
+                self.check_message(reader.root)
+
+            self.assertIsNone(reader.root)
+            self.assertIsNone(reader.buffer)
+
+    def test_capnp_reader_mmap(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            self.write_message(schema, message_fname)
+
+            with CapnpReader(schema.A, message_fname,
+                             use_mmap=True) as reader:
+                self.assertIsInstance(reader.buffer, mmap.mmap)
+                self.check_message(reader.root)
+
+            self.assertIsNone(reader.root)
+            self.assertIsNone(reader.buffer)
+
+    def test_write_capnp_message(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            path_fname = os.path.join(tmp_dir, 'path.bin')
+            fd_fname = os.path.join(tmp_dir, 'fd.bin')
+            file_fname = os.path.join(tmp_dir, 'file.bin')
+
+            self.write_message(schema, path_fname)
+
+            fd = os.open(fd_fname, os.O_WRONLY | os.O_CREAT)
+            try:
+                self.write_message(schema, fd)
+            finally:
+                os.close(fd)
+
+            with open(file_fname, 'wb') as f:
+                self.write_message(schema, f)
+
+            contents = []
+            for fname in (path_fname, fd_fname, file_fname):
+                with open(fname, 'rb') as f:
+                    contents.append(f.read())
+
+            self.assertEqual(contents[1], contents[0])
+            self.assertEqual(contents[2], contents[0])
+
+            with CapnpReader(schema.A, path_fname) as reader:
+                self.check_message(reader.root)
+
+    def test_write_capnp_message_pipe(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            self.write_message(schema, message_fname)
+            with open(message_fname, 'rb') as f:
+                expected = f.read()
+
+            read_fd, write_fd = os.pipe()
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    self.write_message(schema, f)
+
+                chunks = []
+                while True:
+                    chunk = os.read(read_fd, 4096)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                os.close(read_fd)
+
+            self.assertEqual(b''.join(chunks), expected)
+
+    def test_write_capnp_message_packed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            packed_fname = os.path.join(tmp_dir, 'packed.bin')
+            self.write_message(schema, message_fname)
+            self.write_message(schema, packed_fname, packed=True)
+
+            self.assertLess(
+                os.path.getsize(packed_fname), os.path.getsize(message_fname)
+            )
+
+            with CapnpReader(schema.A, packed_fname, packed=True) as reader:
+                self.check_message(reader.root)
+
+    def test_capnp_reader_leak(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            self.write_message(schema, message_fname)
+
+            with self.assertRaises(AssertionError):
+                with CapnpReader(schema.A, message_fname) as reader:
+                    values = reader.root.l
+
+            del values
+
+    def test_capnp_reader_exception(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            schema = self.load_message_schema(tmp_dir)
+            message_fname = os.path.join(tmp_dir, 'message.bin')
+            self.write_message(schema, message_fname)
+
+            with self.assertRaisesRegex(ValueError, 'in block'):
+                with CapnpReader(schema.A, message_fname,
+                                 use_mmap=True) as reader:
+                    values = reader.root.l
+                    raise ValueError('in block')
+
+            del values
+            self.assertIsNone(reader.root)
+
+
+class RecordingEdgesInserter(object):
+    """ Records what Graph._write_edges writes, like _RrEdgesInserter.
+
+    Edges are written to preallocated list elements, but each metadata list
+    is allocated when it is written, so two writes give the same message
+    bytes when they write the same edges and the same metadata in the same
+    order.
+
+    """
+
+    def __init__(self, builder, num_edges, node_remap):
+        self.node_remap = node_remap
+        self.edges = [None] * num_edges
+        self.metadata = []
+
+    def add_edge(self, index, src_node, sink_node, switch_id):
+        self.edges[index] = (
+            self.node_remap[src_node], self.node_remap[sink_node], switch_id
+        )
+
+    def add_edges(self, first, src_nodes, sink_nodes, switch_ids):
+        for index, edge in enumerate(zip(src_nodes, sink_nodes, switch_ids),
+                                     first):
+            self.add_edge(index, *edge)
+
+    def set_metadata(self, index, metadata):
+        self.metadata.append((index, list(metadata)))
+
+
+class Graph2CapnpEdgeWriterTests(unittest.TestCase):
+    def write_edges(self, edge_sources, num_edges, node_remap):
+        inserters = []
+
+        def make_inserter(*args):
+            inserters.append(RecordingEdgesInserter(*args))
+            return inserters[-1]
+
+        with mock.patch.object(graph2_capnp.graph2_cpy, '_RrEdgesInserter',
+                               make_inserter):
+            Graph.__new__(Graph)._write_edges(
+                SimpleNamespace(_parent=None), num_edges, edge_sources,
+                node_remap
+            )
+
+        inserter, = inserters
+        return inserter.edges, inserter.metadata
+
+    def test_edge_store_writes(self):
+        edges = [
+            graph2.Edge(
+                src_node=idx % 7,
+                sink_node=(idx * 3) % 7,
+                switch_id=idx % 2,
+                metadata=((('fasm_features', 'EDGE_{}'.format(idx)), )
+                          if idx % 4 == 1 else None)
+            ) for idx in range(20)
+        ]
+        store = graph2.EdgeStore()
+        store.add_edges(
+            array('I', [edge.src_node for edge in edges]),
+            array('I', [edge.sink_node for edge in edges]),
+            array('I', [edge.switch_id for edge in edges]),
+        )
+        # Metadata added out of edge order.
+        for idx in reversed(range(len(edges))):
+            if edges[idx].metadata is not None:
+                store.metadata[idx] = edges[idx].metadata
+        node_remap = array('I', [6 - idx for idx in range(7)])
+
+        for first_source in ([], graph2.EdgeStore()):
+            written = self.write_edges(
+                (first_source, store), len(edges), node_remap
+            )
+            self.assertEqual(
+                written,
+                self.write_edges((first_source, edges), len(edges), node_remap)
+            )
+
+        written_edges, written_metadata = written
+        self.assertEqual(
+            written_edges, [
+                (node_remap[edge.src_node], node_remap[edge.sink_node],
+                 edge.switch_id) for edge in edges
+            ]
+        )
+        self.assertEqual(
+            [idx for idx, _ in written_metadata],
+            [idx for idx, edge in enumerate(edges) if edge.metadata]
+        )
+
+
+@unittest.skipUnless(RR_GRAPH_SCHEMA, 'RR_GRAPH_SCHEMA is not set')
+class Graph2CapnpSerializeTests(unittest.TestCase):
+    def setUp(self):
+        switch = graph2.Switch(
+            id=0,
+            name='__vpr_delayless_switch__',
+            type=graph2.SwitchType.SHORT,
+            timing=None,
+            sizing=graph2.SwitchSizing(mux_trans_size=0, buf_size=0),
+        )
+        segment = graph2.Segment(
+            id=0,
+            name='s0',
+            timing=graph2.SegmentTiming(r_per_meter=1, c_per_meter=1)
+        )
+
+        self.num_nodes = 2000
+        nodes = graph2.NodeStore()
+        for idx in range(self.num_nodes):
+            nodes.append(
+                graph2.Node(
+                    id=idx,
+                    type=graph2.NodeType.CHANX,
+                    direction=graph2.NodeDirection.INC_DIR,
+                    capacity=1,
+                    loc=graph2.NodeLoc(
+                        x_low=idx % 10,
+                        y_low=1,
+                        x_high=idx % 10 + 1,
+                        y_high=1,
+                        side=Direction.NO_SIDE,
+                        ptc=idx // 10,
+                    ),
+                    timing=graph2.NodeTiming(r=1, c=1),
+                    metadata=None,
+                    segment=graph2.NodeSegment(segment_id=0),
+                    canonical_loc=None,
+                    connection_box=None,
+                )
+            )
+
+        self.edges = graph2.EdgeStore(
+            graph2.Edge(
+                src_node=idx,
+                sink_node=(idx + 1) % self.num_nodes,
+                switch_id=0,
+                metadata=((('fasm_features', 'EDGE_{}'.format(idx)), )
+                          if idx % 10 == 0 else None)
+            ) for idx in range(self.num_nodes)
+        )
+
+        self.graph = Graph.__new__(Graph)
+        self.graph.rr_graph_schema = capnp.load(
+            RR_GRAPH_SCHEMA,
+            imports=[os.path.dirname(os.path.dirname(capnp.__file__))]
+        )
+        self.graph.root_attrib = {
+            'tool_comment': '',
+            'tool_name': 'test',
+            'tool_version': '',
+        }
+        self.graph.graph = graph2.Graph(
+            switches=[switch],
+            segments=[segment],
+            block_types=[],
+            grid=[],
+            nodes=nodes,
+            build_pin_edges=False,
+        )
+
+        self.channels = graph2.Channels(
+            chan_width_max=200,
+            x_min=0,
+            y_min=0,
+            x_max=200,
+            y_max=200,
+            x_list=[],
+            y_list=[],
+        )
+        self.connection_boxes = graph2.ConnectionBoxes(
+            x_dim=0, y_dim=0, boxes=[]
+        )
+
+    def serialize(self, output_file_name, **kwargs):
+        self.graph.serialize_to_capnp(
+            self.channels,
+            self.connection_boxes,
+            self.num_nodes,
+            self.graph.graph.nodes,
+            len(self.edges),
+            self.edges,
+            output=output_file_name,
+            **kwargs
+        )
+
+    def serialize_segment_count(self, **kwargs):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name, **kwargs)
+
+            # Stream framing starts with the segment count minus one.
+            with open(output_file_name, 'rb') as f:
+                segment_count, = struct.unpack('<I', f.read(4))
+
+        return segment_count + 1
+
+    def test_estimated_first_segment(self):
+        self.assertEqual(self.serialize_segment_count(), 1)
+
+    def test_default_first_segment(self):
+        self.assertGreater(
+            self.serialize_segment_count(first_segment_words=0), 1
+        )
+
+    def test_small_first_segment(self):
+        self.assertGreater(
+            self.serialize_segment_count(first_segment_words=1024), 1
+        )
+
+    def test_mmap_read(self):
+        # Some pin nodes, so filter_nodes keeps part of the graph.
+        nodes = self.graph.graph.nodes
+        for idx in range(0, self.num_nodes, 7):
+            nodes.type[idx] = graph2.NodeType.SINK._value_
+
+        options = [
+            dict(filter_nodes=False, load_edges=True),
+            dict(filter_nodes=True, load_edges=True),
+            dict(filter_nodes=False, load_edges=False),
+            dict(filter_nodes=True, load_edges=False, rebase_nodes=True),
+            dict(filter_nodes=False, load_edges=False, rebase_nodes=True),
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name)
+
+            for kwargs in options:
+                graphs = [
+                    graph_from_capnp(
+                        self.graph.rr_graph_schema,
+                        output_file_name,
+                        use_mmap=use_mmap,
+                        **kwargs
+                    ) for use_mmap in (False, True)
+                ]
+
+                self.assertEqual(graphs[1], graphs[0], kwargs)
+                self.assertEqual(
+                    len(graphs[1]['edges']),
+                    len(self.edges) if kwargs['load_edges'] else 0, kwargs
+                )
+                if kwargs['filter_nodes']:
+                    self.assertEqual(
+                        len(graphs[1]['nodes']),
+                        len(range(0, self.num_nodes, 7)), kwargs
+                    )
+                if kwargs.get('rebase_nodes'):
+                    self.assertEqual(
+                        [node.id for node in graphs[1]['nodes']],
+                        list(range(len(graphs[1]['nodes']))), kwargs
+                    )
+
+    def test_edge_store_serialize(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Edge metadata is only estimated for an EdgeStore, so use the
+            # same first segment size for both.
+            contents = []
+            for edges in (self.edges, list(self.edges)):
+                output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+                self.graph.serialize_to_capnp(
+                    self.channels,
+                    self.connection_boxes,
+                    self.num_nodes,
+                    self.graph.graph.nodes,
+                    len(self.edges),
+                    edges,
+                    output=output_file_name,
+                    first_segment_words=1 << 18,
+                )
+
+                with open(output_file_name, 'rb') as f:
+                    contents.append(f.read())
+
+        self.assertEqual(contents[0], contents[1])
+
+    @unittest.skipUnless(NATIVE_NODE_INSERTER, 'no native node inserter')
+    def test_native_node_writer(self):
+        nodes = self.graph.graph.nodes
+        nodes.metadata[3] = (('fasm_features', 'NODE_3'), )
+        nodes.metadata[7] = [
+            graph2.NodeMetadata(
+                name='fasm_features',
+                x_offset=0,
+                y_offset=0,
+                z_offset=0,
+                value='NODE_7'
+            )
+        ]
+
+        written_nodes = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            for native_node_writer in (True, False):
+                self.graph.native_node_writer = native_node_writer
+                self.serialize(output_file_name)
+
+                with CapnpReader(self.graph.rr_graph_schema.RrGraph,
+                                 output_file_name) as reader:
+                    written_nodes.append(
+                        [
+                            (read_node(node), read_metadata(node.metadata))
+                            for node in reader.root.rrNodes.nodes
+                        ]
+                    )
+
+        self.assertEqual(written_nodes[0], written_nodes[1])
+        self.assertEqual(written_nodes[0][3][1], [('fasm_features', 'NODE_3')])
+        self.assertEqual(written_nodes[0][7][1], [('fasm_features', 'NODE_7')])
+
+    def test_edge_view(self):
+        edges = list(self.edges)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name)
+
+            with CapnpEdgeView.open(self.graph.rr_graph_schema,
+                                    output_file_name) as view:
+                self.assertEqual(len(view), len(edges))
+                self.assertEqual(list(view), edges)
+                self.assertEqual(view[10], edges[10])
+                self.assertEqual(view[-1], edges[-1])
+                self.assertEqual(view[::7], edges[::7])
+
+                view_slice = view[5:25]
+                self.assertIsInstance(view_slice, CapnpEdgeView)
+                self.assertEqual(len(view_slice), 20)
+                self.assertEqual(list(view_slice), edges[5:25])
+                self.assertEqual(list(view_slice[2:4]), edges[7:9])
+
+                columns = view_slice.to_arrays()
+                self.assertEqual(
+                    list(columns['src_node']),
+                    [edge.src_node for edge in edges[5:25]]
+                )
+                self.assertEqual(
+                    list(view_slice.to_edge_store()), edges[5:25]
+                )
+
+                src_nodes = set(range(0, self.num_nodes, 3))
+                sink_nodes = set(range(0, self.num_nodes, 2))
+                self.assertEqual(
+                    list(view.filter(src_nodes=src_nodes)),
+                    [edge for edge in edges if edge.src_node in src_nodes]
+                )
+                self.assertEqual(
+                    list(
+                        view.filter(
+                            src_nodes=src_nodes, sink_nodes=sink_nodes
+                        )
+                    ), [
+                        edge for edge in edges if edge.src_node in src_nodes
+                        and edge.sink_node in sink_nodes
+                    ]
+                )
+                self.assertEqual(len(view.filter(sink_nodes=())), 0)
+
+    def test_edge_view_packed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name, packed=True)
+
+            with CapnpEdgeView.open(self.graph.rr_graph_schema,
+                                    output_file_name, packed=True) as view:
+                self.assertEqual(list(view), list(self.edges))
+                self.assertEqual(
+                    list(view[5:25].to_edge_store()), list(self.edges)[5:25]
+                )
+
+    def test_edge_view_exception(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name)
+
+            with self.assertRaises(ValueError):
+                with CapnpEdgeView.open(self.graph.rr_graph_schema,
+                                        output_file_name) as view:
+                    edge = view[0]
+                    view_slice = view[5:25]
+                    raise ValueError((edge, len(view_slice)))
+
+    def test_native_decoder(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file_name = os.path.join(tmp_dir, 'rr_graph.bin')
+            self.serialize(output_file_name)
+
+            graphs = [
+                graph_from_capnp(
+                    self.graph.rr_graph_schema,
+                    output_file_name,
+                    filter_nodes=False,
+                    load_edges=True,
+                    native_decoder=native_decoder,
+                ) for native_decoder in (False, True)
+            ]
+
+        python_graph, native_graph = graphs
+        self.assertIsInstance(native_graph['nodes'], graph2.NodeStore)
+        self.assertIsInstance(native_graph['edges'], graph2.EdgeStore)
+        self.assertEqual(len(python_graph['nodes']), self.num_nodes)
+        self.assertEqual(
+            list(native_graph['nodes']), list(python_graph['nodes'])
+        )
+        self.assertEqual(
+            list(native_graph['edges']), list(python_graph['edges'])
+        )
+        self.assertEqual(list(native_graph['edges']), list(self.edges))
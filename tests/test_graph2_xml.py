@@ -1,9 +1,123 @@
+import os
+import tempfile
 import unittest
+from rr_graph.graph2 import Channels, ChannelList, MemoryPhaseTracker, \
+    NodeTiming
 from rr_graph.graph2_xml import Graph
+from rr_graph.tracks import Track
+
+RR_GRAPH_XML = """<rr_graph tool_name="vpr" tool_version="test" tool_comment="">
+<switches>
+<switch id="0" type="mux" name="mux"><timing R="0" Cin="1" Cout="2" Tdel="0"/><sizing mux_trans_size="0" buf_size="1"/></switch>
+<switch id="1" type="short" name="__vpr_delayless_switch__"><timing R="0" Cin="0" Cout="0" Tdel="0"/><sizing mux_trans_size="0" buf_size="0"/></switch>
+</switches>
+<segments>
+<segment id="0" name="s0"><timing R_per_meter="1" C_per_meter="1"/></segment>
+</segments>
+<block_types>
+<block_type id="0" name="b0" width="1" height="1">
+<pin_class type="INPUT"><pin ptc="0">p1</pin></pin_class>
+<pin_class type="OUTPUT"><pin ptc="1">p2</pin></pin_class>
+</block_type>
+</block_types>
+<grid>
+<grid_loc x="0" y="0" block_type_id="0" width_offset="0" height_offset="0"/>
+</grid>
+<rr_nodes>
+<node id="0" type="IPIN" capacity="1"><loc xlow="0" ylow="0" xhigh="0" yhigh="0" side="LEFT" ptc="0"/><timing R="0" C="0"/></node>
+<node id="1" type="SINK" capacity="1"><loc xlow="0" ylow="0" xhigh="0" yhigh="0" ptc="0"/><timing R="0" C="0"/></node>
+<node id="2" type="OPIN" capacity="1"><loc xlow="0" ylow="0" xhigh="0" yhigh="0" side="LEFT" ptc="1"/><timing R="0" C="0"/></node>
+<node id="3" type="SOURCE" capacity="1"><loc xlow="0" ylow="0" xhigh="0" yhigh="0" ptc="1"/><timing R="0" C="0"/></node>
+</rr_nodes>
+<rr_edges>
+</rr_edges>
+</rr_graph>
+"""
+
+CHANNELS = Channels(
+    chan_width_max=0,
+    x_min=0,
+    y_min=0,
+    x_max=0,
+    y_max=0,
+    x_list=[ChannelList(0, 0)],
+    y_list=[ChannelList(0, 0)],
+)
+
 
 class Graph2XmlTests(unittest.TestCase):
     def setUp(self):
-        pass
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.input_file_name = os.path.join(self.tmpdir.name, 'in.xml')
+        with open(self.input_file_name, 'w') as f:
+            f.write(RR_GRAPH_XML)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def serialize(self, graph, name, **kwargs):
+        graph.output_file_name = os.path.join(self.tmpdir.name, name)
+        graph.serialize_to_xml(
+            channels_obj=CHANNELS,
+            connection_box_obj=None,
+            nodes_obj=graph.graph.nodes,
+            edges_obj=graph.graph.edges,
+            **kwargs
+        )
+
+        with open(graph.output_file_name) as f:
+            return f.read()
 
     def test_import(self):
         _ = Graph
+
+    def test_serialize(self):
+        graph = Graph(self.input_file_name)
+        self.assertEqual(len(graph.graph.nodes), 4)
+        self.assertEqual(len(graph.graph.edges), 2)
+
+        output = self.serialize(graph, 'out.xml')
+        self.assertIn('<edge src_node="0" sink_node="1" switch_id="1"/>', output)
+        self.assertIn('<edge src_node="3" sink_node="2" switch_id="1"/>', output)
+
+    def test_node_timing(self):
+        graph = Graph(self.input_file_name)
+        for y, timing in enumerate((None, NodeTiming(r=1.5, c=2.0))):
+            graph.graph.add_track(
+                Track(direction='X', x_low=0, x_high=1, y_low=y, y_high=y),
+                segment_id=0,
+                ptc=0,
+                timing=timing,
+            )
+
+        output = self.serialize(graph, 'out.xml')
+        self.assertEqual(output.count('<timing R="0.0" C="0.0"/>'), 4)
+        self.assertEqual(output.count('<timing R="1" C="1"/>'), 1)
+        self.assertEqual(output.count('<timing R="1.5" C="2.0"/>'), 1)
+
+    def test_virtual_pin_edges(self):
+        graph = Graph(self.input_file_name)
+        virtual_graph = Graph(self.input_file_name, virtual_pin_edges=True)
+        self.assertEqual(len(virtual_graph.graph.edges), 0)
+
+        self.assertEqual(
+            self.serialize(virtual_graph, 'virtual.xml'),
+            self.serialize(graph, 'out.xml')
+        )
+
+    def test_array_node_remap(self):
+        graph = Graph(self.input_file_name)
+        remap = graph.graph.compute_node_remap('type_loc')
+        self.assertEqual(
+            self.serialize(graph, 'array.xml', node_remap=remap),
+            self.serialize(
+                graph, 'callable.xml', node_remap=lambda x: remap[x]
+            )
+        )
+
+    def test_memory_phases(self):
+        with MemoryPhaseTracker() as tracker:
+            graph = Graph(self.input_file_name)
+            self.serialize(graph, 'out.xml')
+
+        self.assertEqual(sorted(tracker.peaks), ['construction', 'serialize'])